@@ -4,4 +4,6 @@ CONFIG = {
     'video_dir': 'var/videos/',
     'video_url': '/videos/',
     'add_parent_stings': 'before',
+    'page_size': 20,
+    'feed_size': 50,
 }
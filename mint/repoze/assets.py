@@ -0,0 +1,130 @@
+""" Fingerprinted, precompressed static assets
+
+    At startup `build_assets` copies everything in the package's `static`
+    directory into `asset_dir`, both under its own name and under a name
+    including a hash of its contents (`css/screen.0123456789ab.css`), with
+    gzipped siblings for text files. Templates link to the fingerprinted
+    names through the `static_url` global, and `AssetServer` lets browsers
+    cache those forever since a change to a file changes its name.
+"""
+from os import walk, sep
+from os.path import join, splitext, dirname, exists
+import re
+import logging
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from mint.repoze.fileserver import FileServer
+from mint.repoze.feeds import write_atomically
+
+log = logging.getLogger('mint.repoze.assets')
+
+default_source_dir = join(dirname(__file__), 'static')
+
+# extensions worth gzipping
+compressible = frozenset(['.css', '.js', '.html', '.htm', '.svg', '.txt', '.xml', '.json'])
+
+fingerprint_re = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+
+MANIFEST_NAME = 'manifest.json'
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+def fingerprint(name, digest):
+    """ Returns `name` with the start of `digest` before its extension
+    
+        >>> fingerprint('css/screen.css', '0123456789abcdef0123456789abcdef')
+        'css/screen.0123456789ab.css'
+    """
+    base, ext = splitext(name)
+    return '%s.%s%s' % (base, digest[:12], ext)
+
+def build_assets(source_dir, asset_dir):
+    """ Copies the files in `source_dir` to `asset_dir` under their own and
+        their fingerprinted names, gzipping text files alongside. Returns a
+        manifest mapping each name to its fingerprinted name, which is also
+        written to `asset_dir`.
+        
+        >>> from tempfile import mkdtemp
+        >>> source, built = mkdtemp(), mkdtemp()
+        >>> write_atomically(join(source, 'css', 'screen.css'), 'body {}')
+        >>> build_assets(source, built)
+        {'css/screen.css': 'css/screen.fcdce6b6d6e2.css'}
+        >>> exists(join(built, 'css', 'screen.fcdce6b6d6e2.css.gz')), exists(join(built, 'css', 'screen.css'))
+        (True, True)
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in walk(source_dir):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            src = join(dirpath, filename)
+            name = src[len(source_dir):].lstrip(sep).replace(sep, '/')
+            f = open(src, 'rb')
+            try:
+                body = f.read()
+            finally:
+                f.close()
+            built = fingerprint(name, md5(body).hexdigest())
+            for target in (name, built):
+                dst = join(asset_dir, *target.split('/'))
+                if target == built and exists(dst):
+                    # named after its contents, so already up to date
+                    continue
+                write_atomically(dst, body)
+                if splitext(name)[1] in compressible:
+                    write_atomically(dst + '.gz', body, compress=True)
+            manifest[name] = built
+    write_atomically(join(asset_dir, MANIFEST_NAME), json.dumps(manifest))
+    log.info('built %s static assets in `%s`' % (len(manifest), asset_dir))
+    return manifest
+
+class StaticURL(object):
+    """ The `static_url` template global: returns the URL for a file in the
+        static directory, fingerprinted if it is in `manifest`
+        
+        >>> static_url = StaticURL('/static/', {'css/screen.css': 'css/screen.0123456789ab.css'})
+        >>> static_url('css/screen.css'), static_url('/images/logo.png')
+        ('/static/css/screen.0123456789ab.css', '/static/images/logo.png')
+    """
+    
+    def __init__(self, prefix='/static/', manifest=None):
+        self.prefix = prefix.rstrip('/') + '/'
+        self.manifest = manifest or {}
+    
+    def __call__(self, name):
+        name = name.lstrip('/')
+        return self.prefix + self.manifest.get(name, name)
+    
+
+def configure_assets(env, options):
+    """ Builds the assets into the `asset_dir` option (if there is one) and
+        adds `static_url` to the globals of the Jinja2 environment `env`
+    """
+    manifest = {}
+    asset_dir = options.get('asset_dir')
+    if asset_dir:
+        manifest = build_assets(options.get('static_dir') or default_source_dir, asset_dir)
+    env.globals['static_url'] = StaticURL(options.get('static_url', '/static/'), manifest)
+
+class AssetServer(FileServer):
+    """ Serves built assets, gzipped where the client accepts it.
+        Fingerprinted files never change, so they may be cached for a year.
+    """
+    
+    def cache_control(self, path):
+        if fingerprint_re.search(path):
+            return 'public, max-age=%d, immutable' % ONE_YEAR
+        return super(AssetServer, self).cache_control(path)
+    
+
+def make_static_app(global_conf, document_root, cache_max_age=3600, stat_ttl=5, **kw):
+    """ paste.app_factory for serving the assets built into `document_root` """
+    return AssetServer(document_root, cache_max_age=cache_max_age, stat_ttl=stat_ttl, precompressed=True)
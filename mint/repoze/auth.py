@@ -37,27 +37,53 @@ from repoze.who.interfaces import IAuthenticator, IMetadataProvider
 from repoze.who.utils import resolveDotted
 from repoze.bfg.interfaces import IRootFactory
 
-from repoze.zodbconn.finder import dbfactory_from_uri
+import transaction
+import logging
 
-def default_checker(password, against):
-    return password == against
+from mint.repoze.cache import groups_cache, credentials_cache
+from mint.repoze.pool import ENVIRON_KEY as CONNECTION_KEY
+from mint.repoze.passwords import credential_digest
+
+log = logging.getLogger('mint.repoze.auth')
+
+def default_checker(user, password):
+    return user.check_password(password)
 
 class ZODBPlugin(object):
+    """ Authenticates users stored in the application's database, through
+        the request's own connection (or one of its own, outside the
+        ConnectionMiddleware). Users' groups are kept in `groups` for a
+        short while so most requests don't load the user at all, and
+        credentials which have been checked are remembered in `verified` so
+        that clients sending them with every request (through basic auth)
+        don't have their password hashed every time.
+    """
     implements(IAuthenticator, IMetadataProvider)
-    dbfactory = staticmethod(dbfactory_from_uri) # for testing override
     
-    def __init__(self, zodb_uri, users_finder, base, checker=default_checker):
-        self.zodb_uri = zodb_uri
+    def __init__(self, get_db, users_finder, base, checker=default_checker, groups=groups_cache, verified=credentials_cache):
+        self.get_db = get_db
         self.users_finder = users_finder
         self.base = base
-        self.db = None
         self.checker = checker
+        self.groups = groups
+        self.verified = verified
+    
+    def _getconn(self, environ):
+        """ Returns a connection and, if it was opened just for this call,
+            its own transaction manager (None for the request's connection,
+            whose transaction repoze.tm finishes). A connection of our own
+            must be committed or aborted and closed afterwards.
+        """
+        connection = environ.get(CONNECTION_KEY)
+        if connection is not None:
+            return connection.get(), None
+        txn_manager = transaction.TransactionManager()
+        return self.get_db().open(transaction_manager=txn_manager), txn_manager
     
-    def _getdb(self):
-        if self.db is None:
-            dbfactory = self.dbfactory(self.zodb_uri)
-            self.db = dbfactory()
-        return self.db
+    def _closeconn(self, conn, txn_manager):
+        if txn_manager is not None:
+            txn_manager.abort()
+            conn.close()
     
     def _getusers(self, conn):
         root = conn.root()
@@ -66,30 +92,50 @@ class ZODBPlugin(object):
     def authenticate(self, environ, identity):
         if not 'login' in identity:
             return None
-        conn = self._getdb().open()
+        login, password = identity['login'], identity['password']
+        conn, txn_manager = self._getconn(environ)
         try:
             users = self._getusers(conn)
-            user = users.get(identity['login'], None)
-            if user and self.checker(identity['password'], user.password):
+            user = users.get(login, None)
+            if user is None:
+                return None
+            key = credential_digest(login, password)
+            # a changed password no longer matches the remembered hash
+            if self.verified.get(key) == user.password:
+                return user.id
+            if self.checker(user, password):
+                if txn_manager is not None and user._p_changed:
+                    # the checker upgraded the user's password hash
+                    try:
+                        txn_manager.commit()
+                    except Exception:
+                        log.exception('could not store the new password hash for `%s`' % login)
+                self.verified.set(key, user.password)
                 return user.id
         finally:
-            conn.close()
+            self._closeconn(conn, txn_manager)
     
     def add_metadata(self, environ, identity):
         userid = identity.get('repoze.who.userid')
-        conn = self._getdb().open()
-        try:
-            users = self._getusers(conn)
-            user = users.get(userid, None)
-            if user:
-                identity['groups'] = user.groups
-        except:
-            identity['groups'] = []
-        finally:
-            conn.close()
-        
+        groups = self.groups.get(userid)
+        if groups is None:
+            conn, txn_manager = self._getconn(environ)
+            try:
+                try:
+                    users = self._getusers(conn)
+                    user = users.get(userid, None)
+                    if user is None:
+                        return
+                    groups = tuple(user.groups)
+                    self.groups.set(userid, groups)
+                except:
+                    groups = ()
+            finally:
+                self._closeconn(conn, txn_manager)
+        identity['groups'] = list(groups)
+    
 
-def middleware(app, base):
+def middleware(app, base, get_db, groups_cache_ttl=60, credentials_cache_ttl=300):
     from repoze.who.middleware import PluggableAuthenticationMiddleware
     from repoze.who.interfaces import IIdentifier, IChallenger
     from repoze.who.plugins.basicauth import BasicAuthPlugin
@@ -97,12 +143,12 @@ def middleware(app, base):
     from repoze.who.plugins.form import FormPlugin
     
     def find_users(root, base):
-        from mint.repoze.root import ZODBInit
-        init = ZODBInit(base)
-        mint_root = init(root)
-        return mint_root['users']
+        # the root was created when the application started
+        return root[base]['users']
     
-    zodb = ZODBPlugin('zeo://localhost:8100', find_users, base, checker=default_checker)
+    groups_cache.configure(groups_cache.cache.max_size, groups_cache_ttl)
+    credentials_cache.configure(credentials_cache.cache.max_size, credentials_cache_ttl)
+    zodb = ZODBPlugin(get_db, find_users, base, checker=default_checker)
     basicauth = BasicAuthPlugin('Mint')
     auth_tkt = AuthTktCookiePlugin('secret', 'auth_tkt')
     # move to RedirectingFormPlugin
@@ -0,0 +1,488 @@
+""" Caching of rendered pages and widgets
+
+    Anonymous visitors all see the same pages, which only change when
+    something is committed to the database. `PageCache` keeps the rendered
+    responses of views marked `cacheable` in memory, keyed on the request
+    and the id of the last transaction the database has seen, so any commit
+    (from this process or another ZEO client) invalidates every entry.
+    Views marked `cacheable_for_slot` embed a widget which rotates on a
+    timer, and their entries also expire when its slot ends.
+    
+    Widgets are cached separately by `FragmentCache`, since they are shared
+    between pages and often between visitors too. Each widget registers a
+    vary function describing what its output depends on.
+"""
+from threading import Lock
+from time import time
+from functools import wraps
+from email.utils import parsedate_tz, mktime_tz
+
+from repoze.bfg.traversal import model_path
+import transaction
+
+from mint.repoze.fileserver import not_modified
+
+import logging
+
+log = logging.getLogger('mint.repoze.cache')
+
+def hit_rate(hits, misses):
+    """ Returns the proportion of lookups which were hits
+        
+        >>> hit_rate(3, 1), hit_rate(0, 0)
+        (0.75, 0.0)
+    """
+    if not hits + misses:
+        return 0.0
+    return float(hits) / (hits + misses)
+
+class LRUCache(object):
+    """ A mapping which holds at most `max_size` worth of values, dropping
+        the least recently used entries to make room. Each value's size is
+        given when it is stored.
+        
+        >>> cache = LRUCache(10)
+        >>> cache.set('a', 'aaaa', 4)
+        >>> cache.set('b', 'bbbb', 4)
+        >>> cache.get('a')
+        'aaaa'
+        >>> cache.set('c', 'cccc', 4)
+        >>> cache.get('b') is None, len(cache), cache.size
+        (True, 2, 8)
+        >>> cache.set('d', 'too big', 11)
+        >>> cache.get('d') is None
+        True
+        >>> cache.set('c', 'much too big', 12)
+        >>> cache.get('c') is None, cache.size
+        (True, 4)
+        >>> cache.hits, cache.misses
+        (1, 3)
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._entries = {}
+        # a circular doubly linked list of [previous, next, key] links,
+        # most recently used last
+        self._head = []
+        self._head[:] = [self._head, self._head, None]
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def _unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+    
+    def _append(self, link):
+        last = self._head[0]
+        link[0], link[1] = last, self._head
+        last[1] = link
+        self._head[0] = link
+    
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            link, value, size = entry
+            self._unlink(link)
+            self._append(link)
+            return value
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value, size):
+        self._lock.acquire()
+        try:
+            # an older value mustn't outlive a newer one which doesn't fit
+            self._remove(key)
+            if size > self.max_size:
+                return
+            while self._entries and self.size + size > self.max_size:
+                self._remove(self._head[1][2])
+            link = [None, None, key]
+            self._append(link)
+            self._entries[key] = (link, value, size)
+            self.size += size
+        finally:
+            self._lock.release()
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry[0])
+            self.size -= entry[2]
+    
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._head[:] = [self._head, self._head, None]
+            self.size = 0
+        finally:
+            self._lock.release()
+    
+    def stats(self):
+        return {
+            'entries': len(self),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': hit_rate(self.hits, self.misses),
+        }
+    
+
+class TTLCache(object):
+    """ An LRUCache of at most `max_entries` values, each of which is
+        forgotten `ttl` seconds after it was stored
+        
+        >>> cache = TTLCache(2, ttl=60)
+        >>> cache.set('admin', ['contributor'])
+        >>> cache.get('admin')
+        ['contributor']
+        >>> cache.ttl = -1
+        >>> cache.set('admin', ['contributor'])
+        >>> cache.get('admin') is None, len(cache.cache)
+        (True, 0)
+    """
+    
+    def __init__(self, max_entries=1024, ttl=60):
+        self.configure(max_entries, ttl)
+    
+    def configure(self, max_entries, ttl):
+        """ Sets the number of entries (0 turns caching off) and how many
+            seconds each is kept for, dropping everything cached so far
+        """
+        self.cache = LRUCache(int(max_entries))
+        self.ttl = float(ttl)
+    
+    def get(self, key, default=None):
+        entry = self.cache.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time():
+            self.cache.delete(key)
+            return default
+        return value
+    
+    def set(self, key, value):
+        self.cache.set(key, (time() + self.ttl, value), 1)
+    
+    def delete(self, key):
+        self.cache.delete(key)
+    
+    def delete_on_commit(self, key):
+        """ Deletes `key` once the current transaction has committed, so a
+            request still seeing the old state can't cache it again, and
+            nothing is lost if the transaction is aborted
+        """
+        transaction.get().addAfterCommitHook(self._delete_committed, (key,))
+    
+    def _delete_committed(self, status, key):
+        if status:
+            self.delete(key)
+    
+    def stats(self):
+        stats = self.cache.stats()
+        stats['ttl'] = self.ttl
+        return stats
+    
+
+def _mark_cacheable(func, expires):
+    # wraps() keeps the view's __module__, without which <scan> skips it
+    @wraps(func)
+    def wrapper(context, request, *args, **kwargs):
+        request.environ['mint.cacheable'] = expires()
+        return func(context, request, *args, **kwargs)
+    return wrapper
+
+def cacheable(func):
+    """ Marks the responses of a view as safe to serve to any anonymous
+        visitor from the page cache
+        
+        >>> def view(context, request):
+        ...     return 'response'
+        >>> cacheable(view).__module__ == view.__module__, cacheable(view).__name__
+        (True, 'view')
+    """
+    return _mark_cacheable(func, lambda: True)
+
+def cacheable_for_slot(seconds):
+    """ Like `cacheable`, for views embedding a widget which varies with
+        `vary_on_slot(seconds)`: their cached responses expire when the
+        current slot ends
+    """
+    def decorator(func):
+        return _mark_cacheable(func, lambda: slot_end(seconds))
+    return decorator
+
+class PageCache(object):
+    """ WSGI middleware serving anonymous GET requests for `cacheable` views
+        from memory. `get_db` returns the ZODB database, whose last
+        transaction id is part of every key. It must sit inside the
+        repoze.who middleware so that logged in users can be told apart.
+    """
+    
+    # headers which may differ between responses for different visitors
+    private_headers = ('set-cookie', 'www-authenticate')
+    
+    def __init__(self, app, get_db, max_size=64 * 1024 * 1024):
+        self.app = app
+        self.get_db = get_db
+        self.cache = LRUCache(int(max_size))
+        self.serial = None
+    
+    def key(self, environ):
+        return (
+            environ.get('HTTP_X_VHM_HOST', ''),
+            environ.get('HTTP_HOST', ''),
+            environ.get('SCRIPT_NAME', ''),
+            environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''),
+        )
+    
+    def stats(self):
+        return self.cache.stats()
+    
+    def not_modified(self, environ, headers):
+        """ Checks the request's conditional headers against the ETag and
+            Last-Modified headers of a cached response
+        """
+        etag = last_modified = None
+        for name, value in headers:
+            if name.lower() == 'etag':
+                etag = value
+            elif name.lower() == 'last-modified':
+                parsed = parsedate_tz(value)
+                if parsed is not None:
+                    last_modified = mktime_tz(parsed)
+        if etag is None and last_modified is None:
+            return False
+        return not_modified(environ, etag, last_modified)
+    
+    def __call__(self, environ, start_response):
+        environ['mint.page_cache'] = self
+        if environ.get('REQUEST_METHOD') != 'GET' or environ.get('repoze.who.identity'):
+            return self.app(environ, start_response)
+        serial = self.get_db().lastTransaction()
+        if serial != self.serial:
+            # everything cached belongs to an earlier transaction
+            if self.serial is not None:
+                self.cache.clear()
+            self.serial = serial
+        key = (serial,) + self.key(environ)
+        cached = self.cache.get(key)
+        if cached is not None and cached[3] is not None and cached[3] <= time():
+            cached = None
+        if cached is not None:
+            status, headers, body, expires = cached
+            if self.not_modified(environ, headers):
+                validators = [(name, value) for name, value in headers if name.lower() in ('etag', 'last-modified')]
+                start_response('304 Not Modified', validators + [('X-Cache', 'HIT')])
+                return []
+            start_response(status, headers + [('X-Cache', 'HIT')])
+            return [body]
+        
+        captured = []
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+            if environ.get('mint.cacheable'):
+                headers = headers + [('X-Cache', 'MISS')]
+            return start_response(status, headers, exc_info)
+        app_iter = self.app(environ, capture)
+        if not environ.get('mint.cacheable') or not captured or not captured[0].startswith('200'):
+            return app_iter
+        status, headers = captured
+        expires = environ['mint.cacheable']
+        if expires is True:
+            expires = None
+        for name, value in headers:
+            if name.lower() in self.private_headers:
+                return app_iter
+        try:
+            body = ''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        size = len(body) + sum([len(name) + len(value) for name, value in headers])
+        self.cache.set(key, (status, headers, body, expires), size)
+        return [body]
+    
+
+def make_page_cache(app, get_db, options):
+    """ Wraps `app` in a PageCache sized by the `page_cache_size` option
+        (in bytes), or returns it untouched if that is 0
+    """
+    max_size = int(options.get('page_cache_size', 64 * 1024 * 1024))
+    if not max_size:
+        return app
+    log.info('caching up to %s bytes of rendered pages' % max_size)
+    return PageCache(app, get_db, max_size)
+
+def serial(ob):
+    """ Returns the `_p_serial` of a stored persistent object, or None if it
+        is new or has uncommitted changes
+        
+        >>> serial(object()) is None
+        True
+    """
+    if getattr(ob, '_p_jar', None) is None:
+        return None
+    # a ghost's serial is z64 (or stale, once it has been invalidated)
+    # until it is loaded
+    ob._p_activate()
+    if ob._p_changed:
+        return None
+    return ob._p_serial
+
+def vary_on_user(context, request):
+    """ For widgets which differ between logged in users """
+    return request.environ.get('REMOTE_USER', '')
+
+def vary_on_context(context, request):
+    """ For widgets which only depend on the stored state of their context """
+    context_serial = serial(context)
+    if context_serial is None:
+        return None
+    return (model_path(context), context_serial)
+
+def vary_on_slot(seconds):
+    """ For widgets which rotate their content every `seconds` seconds """
+    def vary(context, request):
+        return int(time() / seconds)
+    return vary
+
+def slot_end(seconds, now=None):
+    """ Returns when the current slot of `vary_on_slot(seconds)` ends
+        
+        >>> slot_end(300, now=1000), slot_end(300, now=1200)
+        (1200, 1500)
+    """
+    if now is None:
+        now = time()
+    return (int(now / seconds) + 1) * seconds
+
+class FragmentCache(object):
+    """ Caches the output of widgets rendered through `render`. A widget is
+        only cached once it has been registered along with a vary function,
+        which is given the context and request and returns a hashable key
+        for the output (or None if it can't be cached this time).
+        
+        >>> fragments = FragmentCache(max_size=1024, ttl=60)
+        >>> fragments.register('clock_widget', lambda context, request: 'key')
+        >>> calls = []
+        >>> def render(context, request, name):
+        ...     calls.append(name)
+        ...     return '<div>%s</div>' % name
+        >>> fragments.render(None, None, 'clock_widget', render)
+        '<div>clock_widget</div>'
+        >>> fragments.render(None, None, 'clock_widget', render)
+        '<div>clock_widget</div>'
+        >>> fragments.render(None, None, 'other_widget', render)
+        '<div>other_widget</div>'
+        >>> calls
+        ['clock_widget', 'other_widget']
+        >>> stats = fragments.stats()['widgets']
+        >>> stats['clock_widget']['hits'], stats['clock_widget']['misses'], stats['other_widget']['uncached']
+        (1, 1, 1)
+    """
+    
+    def __init__(self, max_size=8 * 1024 * 1024, ttl=300):
+        self.rules = {}
+        self.counters = {}
+        self._lock = Lock()
+        self.configure(max_size, ttl)
+    
+    def configure(self, max_size, ttl):
+        """ Sets the size in bytes (0 turns caching off) and the default
+            number of seconds fragments are kept for, dropping everything
+            cached so far
+        """
+        self.cache = LRUCache(int(max_size))
+        self.ttl = float(ttl)
+    
+    def register(self, name, vary, ttl=None):
+        """ Caches the widget `name` by the key returned from `vary`, for
+            `ttl` seconds (the default if None)
+        """
+        self.rules[name] = (vary, ttl)
+    
+    def count(self, name, outcome):
+        self._lock.acquire()
+        try:
+            counters = self.counters.setdefault(name, {'hits': 0, 'misses': 0, 'uncached': 0})
+            counters[outcome] += 1
+        finally:
+            self._lock.release()
+    
+    def render(self, context, request, name, renderer):
+        """ Returns the output of the widget `name`, from the cache if
+            possible, calling `renderer(context, request, name)` if not
+        """
+        rule = self.rules.get(name)
+        key = None
+        if rule is not None and self.cache.max_size:
+            key = rule[0](context, request)
+        if key is None:
+            self.count(name, 'uncached')
+            return renderer(context, request, name)
+        key = (name, key)
+        now = time()
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > now:
+            self.count(name, 'hits')
+            return cached[1]
+        self.count(name, 'misses')
+        body = renderer(context, request, name)
+        ttl = rule[1]
+        if ttl is None:
+            ttl = self.ttl
+        if body is not None:
+            self.cache.set(key, (now + ttl, body), len(body))
+        return body
+    
+    def stats(self):
+        widgets = {}
+        for name, counters in self.counters.items():
+            widgets[name] = dict(counters, hit_rate=hit_rate(counters['hits'], counters['misses']))
+        return {'cache': self.cache.stats(), 'widgets': widgets}
+    
+
+widget_cache = FragmentCache()
+
+# userid -> groups, for the repoze.who metadata provider
+groups_cache = TTLCache()
+# digests of recently checked logins and passwords -> the password hash
+# they were checked against, so API clients sending their credentials with
+# every request don't pay for hashing each time
+credentials_cache = TTLCache(ttl=300)
+
+def configure_widget_cache(options):
+    """ Sizes the widget cache from the `widget_cache_size` (bytes) and
+        `widget_cache_ttl` (seconds) options
+    """
+    widget_cache.configure(
+        options.get('widget_cache_size', 8 * 1024 * 1024),
+        options.get('widget_cache_ttl', 300),
+    )
@@ -0,0 +1,211 @@
+""" Pre-rendered podcast feeds
+
+    Whenever a transaction changes what a feed would show, the affected
+    `podcast.xml` files are rendered just before the commit and written to
+    `feed_dir` (along with a gzipped copy) once it has succeeded. The
+    `FeedSnapshots` middleware serves those files directly, so polling
+    clients never reach the database. The serial of the transaction which
+    produced each snapshot is written beside it, so that a transaction
+    whose hooks happen to run late never replaces a newer snapshot. Feeds
+    which haven't been written yet, and any page past the first, are still
+    rendered by the `podcast.xml` view.
+"""
+from os import makedirs, rename, unlink, chmod, fdopen
+from os.path import join, isdir, dirname
+from tempfile import mkstemp
+from threading import local, Lock
+from binascii import hexlify
+import gzip
+import logging
+
+import transaction
+
+from mint.repoze.fileserver import FileServer
+
+log = logging.getLogger('mint.repoze.feeds')
+
+FEED_NAME = 'podcast.xml'
+
+# files holding the serial of the transaction a snapshot was rendered by
+VERSION_SUFFIX = '.serial'
+
+def write_atomically(path, body, compress=False):
+    """ Writes `body` to `path` through a temporary file in the same
+        directory, gzipping it first if `compress` is set
+        
+        >>> from tempfile import mkdtemp
+        >>> path = join(mkdtemp(), 'videos', 'podcast.xml')
+        >>> write_atomically(path, '<rss />')
+        >>> write_atomically(path + '.gz', '<rss />', compress=True)
+        >>> open(path).read(), gzip.open(path + '.gz').read()
+        ('<rss />', '<rss />')
+    """
+    directory = dirname(path)
+    if not isdir(directory):
+        makedirs(directory)
+    fd, tmp = mkstemp(suffix='.tmp', dir=directory)
+    out = fdopen(fd, 'wb')
+    try:
+        if compress:
+            compressed = gzip.GzipFile(filename='', mode='wb', fileobj=out)
+            compressed.write(body)
+            compressed.close()
+        else:
+            out.write(body)
+        out.close()
+        chmod(tmp, 0644)
+        rename(tmp, path)
+    except:
+        out.close()
+        unlink(tmp)
+        raise
+
+def render_feed(context):
+    """ Returns the first page of the feed for the ISyndication `context` """
+    from mint.repoze import CONFIG
+    from mint.repoze.views import env
+    items = context.get_page(1, int(CONFIG['feed_size'])).items
+    template = env.get_template('pages/podcast.xml')
+    return template.render(metadata=context.metadata, items=items).encode('utf-8')
+
+def committed_serial(objects):
+    """ Returns, in hex, the newest serial of the persistent `objects`. Read
+        once the transaction has committed, this is its own serial whenever
+        it changed any of them. Ghosts aren't loaded, as that could pick up
+        a later transaction's state.
+        
+        >>> import struct
+        >>> class Dummy(object):
+        ...     def __init__(self, serial):
+        ...         self._p_serial = struct.pack('>Q', serial)
+        >>> committed_serial([Dummy(2), Dummy(16)])
+        '0000000000000010'
+    """
+    return max([hexlify(ob._p_serial) for ob in objects])
+
+def read_serial(path):
+    """ Returns the serial recorded beside the snapshot at `path`, or None """
+    try:
+        f = open(path + VERSION_SUFFIX)
+    except IOError:
+        return None
+    try:
+        return f.read().strip() or None
+    finally:
+        f.close()
+
+class FeedPublisher(object):
+    """ Collects the feeds changed by each transaction and writes them to
+        `feed_dir` when it commits. Feeds are identified by their path from
+        the mint root, such as ('videos',) or ('channels', u'arctic').
+        
+        >>> from tempfile import mkdtemp
+        >>> import struct
+        >>> class Dummy(object):
+        ...     def __init__(self, serial):
+        ...         self._p_serial = struct.pack('>Q', serial)
+        >>> publisher = FeedPublisher(mkdtemp())
+        >>> publisher.write(True, {('videos',): ('<rss>new</rss>', [Dummy(2)])})
+        >>> publisher.write(True, {('videos',): ('<rss>old</rss>', [Dummy(1)])})
+        >>> open(publisher.feed_path(('videos',))).read()
+        '<rss>new</rss>'
+    """
+    
+    def __init__(self, feed_dir=None):
+        self.feed_dir = feed_dir
+        self._local = local()
+        self._writing = Lock()
+    
+    def configure(self, feed_dir):
+        """ Sets the directory feeds are written to, None to stop writing them """
+        self.feed_dir = feed_dir
+    
+    def feed_path(self, path):
+        return join(self.feed_dir, *(list(path) + [FEED_NAME]))
+    
+    def queue(self, root, path):
+        """ Schedules the feed at `path` below `root` to be published when
+            the current transaction commits
+        """
+        if not self.feed_dir:
+            return
+        txn = transaction.get()
+        pending = getattr(self._local, 'pending', None)
+        if pending is None or pending[0] is not txn:
+            pending = self._local.pending = (txn, {}, {})
+            txn.addBeforeCommitHook(self.render, pending[1:])
+            txn.addAfterCommitHook(self.write, pending[2:])
+        pending[1][tuple(path)] = root
+    
+    def render(self, pending, rendered):
+        """ Renders each pending feed into `rendered`. This runs before the
+            commit so it sees the transaction's changes; a feed which fails
+            to render is logged rather than aborting the commit.
+        """
+        for path, root in pending.items():
+            try:
+                context = root
+                for name in path:
+                    context = context[name]
+                rendered[path] = (render_feed(context), context.get_feed_objects())
+            except Exception:
+                log.exception('could not render the feed for `%s`' % '/'.join(path))
+    
+    def write(self, status, rendered):
+        """ Writes the rendered feeds and their gzipped copies if the
+            transaction committed, unless a later transaction has already
+            written a newer snapshot
+        """
+        if not status:
+            return
+        for path, (body, objects) in rendered.items():
+            filename = self.feed_path(path)
+            serial = committed_serial(objects)
+            self._writing.acquire()
+            try:
+                try:
+                    written = read_serial(filename)
+                    if written is not None and written > serial:
+                        continue
+                    write_atomically(filename + '.gz', body, compress=True)
+                    write_atomically(filename, body)
+                    write_atomically(filename + VERSION_SUFFIX, serial)
+                except (IOError, OSError):
+                    log.exception('could not write `%s`' % filename)
+            finally:
+                self._writing.release()
+    
+
+feed_publisher = FeedPublisher()
+
+class FeedSnapshots(object):
+    """ WSGI middleware serving the feeds written by `feed_publisher` from
+        `feed_dir`, gzipped to clients which accept it. Anything else
+        (including feeds with a query string) is passed on to `app`.
+    """
+    
+    def __init__(self, app, feed_dir, cache_max_age=0, stat_ttl=1):
+        self.app = app
+        self.files = FileServer(feed_dir, cache_max_age=cache_max_age, stat_ttl=stat_ttl, precompressed=True)
+    
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if (environ.get('REQUEST_METHOD') not in ('GET', 'HEAD') or environ.get('QUERY_STRING')
+            or not path.endswith('/' + FEED_NAME)):
+            return self.app(environ, start_response)
+        filename = self.files.resolve(path)
+        if filename is None or self.files.stat(filename) is None:
+            return self.app(environ, start_response)
+        return self.files(environ, start_response)
+    
+
+def make_feed_snapshots(app, options):
+    """ Configures `feed_publisher` from the `feed_dir` option and wraps
+        `app` to serve what it writes, or returns `app` untouched if there
+        is no `feed_dir`
+    """
+    feed_dir = options.get('feed_dir')
+    feed_publisher.configure(feed_dir)
+    if not feed_dir:
+        return app
+    return FeedSnapshots(app, feed_dir)
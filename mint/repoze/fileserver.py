@@ -0,0 +1,382 @@
+""" A WSGI application for serving large files such as video encodes
+
+    Supports single and multiple byte ranges, conditional requests through
+    `If-None-Match`, `If-Modified-Since` and `If-Range`, and hands whole
+    files to the server's `wsgi.file_wrapper` so they can be sent without
+    passing through Python. The result of stat-ing each file is cached for
+    a few seconds. With `precompressed` set, a gzipped `.gz` sibling of a
+    file is sent instead to clients which accept it.
+"""
+from os import stat, sep
+from os.path import abspath, normpath, join, isfile
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from mimetypes import guess_type
+from stat import S_ISREG
+from time import time
+from random import random
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+BLOCK_SIZE = 64 * 1024
+
+# requests for more byte ranges than this get the whole file
+MAX_RANGES = 16
+
+# files holding the md5 of the file they sit beside, written at ingest
+ETAG_SUFFIX = '.md5'
+
+def write_etag(path, digest):
+    """ Records `digest` as the content hash of the file at `path` """
+    f = open(path + ETAG_SUFFIX, 'w')
+    try:
+        f.write(digest)
+    finally:
+        f.close()
+
+def parse_range(header, size):
+    """ Returns a list of (start, end) pairs, with `end` exclusive, for the
+        byte ranges in the Range `header` which fall within `size` bytes.
+        Returns None when there is no usable header.
+        
+        >>> parse_range('bytes=0-99', 1000)
+        [(0, 100)]
+        >>> parse_range('bytes=-100, 500-', 1000)
+        [(900, 1000), (500, 1000)]
+        >>> parse_range('bytes=900-2000', 1000)
+        [(900, 1000)]
+        >>> parse_range('bytes=1000-', 1000)
+        []
+        >>> parse_range('bytes=5-1', 1000) is None, parse_range('lines=1-2', 1000) is None
+        (True, True)
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        spec = spec.strip()
+        if '-' not in spec:
+            return None
+        first, last = spec.split('-', 1)
+        try:
+            if first == '':
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size
+            else:
+                start = int(first)
+                if last == '':
+                    end = size
+                elif int(last) < start:
+                    return None
+                else:
+                    end = min(int(last) + 1, size)
+        except ValueError:
+            return None
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+def coalesce_ranges(ranges, size, max_ranges=MAX_RANGES):
+    """ Sorts `ranges` and merges those which overlap or touch. Returns None,
+        meaning the whole file should be sent instead, when there are more
+        than `max_ranges` of them or when several together cover more than
+        half of the `size` bytes.
+        
+        >>> coalesce_ranges([(900, 1000), (0, 100), (50, 200), (200, 300)], 1000)
+        [(0, 300), (900, 1000)]
+        >>> coalesce_ranges([(0, 900)], 1000)
+        [(0, 900)]
+        >>> coalesce_ranges([(0, 400), (500, 1000)], 1000) is None
+        True
+        >>> coalesce_ranges([(i * 10, i * 10 + 1) for i in range(17)], 1000) is None
+        True
+    """
+    if len(ranges) > max_ranges:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > 1 and sum([end - start for start, end in merged]) * 2 > size:
+        return None
+    return merged
+
+def accepts_encoding(header, coding):
+    """ Returns whether an Accept-Encoding `header` allows `coding`, going by
+        its quality values (and a `*` entry if `coding` isn't named)
+        
+        >>> accepts_encoding('gzip, deflate', 'gzip'), accepts_encoding('GZIP;q=0.5', 'gzip')
+        (True, True)
+        >>> accepts_encoding('gzip;q=0, identity', 'gzip'), accepts_encoding('gzip ; Q=0.000', 'gzip')
+        (False, False)
+        >>> accepts_encoding('*', 'gzip'), accepts_encoding('*;q=0', 'gzip'), accepts_encoding('*, gzip;q=0', 'gzip')
+        (True, False, False)
+        >>> accepts_encoding('', 'gzip'), accepts_encoding('x-gzip-like', 'gzip')
+        (False, False)
+    """
+    wildcard = None
+    for item in (header or '').lower().split(','):
+        params = item.split(';')
+        name = params[0].strip()
+        quality = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name == coding:
+            return quality > 0
+        if name == '*':
+            wildcard = quality > 0
+    return bool(wildcard)
+
+def not_modified(environ, etag, mtime):
+    """ Returns whether the client already has the version of a resource
+        identified by `etag` and last modified at `mtime` (seconds since the
+        epoch, or None if unknown), according to its conditional headers
+        
+        >>> not_modified({'HTTP_IF_NONE_MATCH': '"a", "b"'}, '"b"', None)
+        True
+        >>> not_modified({'HTTP_IF_MODIFIED_SINCE': 'Thu, 01 Jan 2009 00:00:00 GMT'}, '"b"', 1230768000)
+        True
+        >>> not_modified({}, '"b"', 1230768000)
+        False
+    """
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and mtime is not None:
+        parsed = parsedate_tz(if_modified_since.split(';')[0])
+        if parsed is not None:
+            return mtime <= mktime_tz(parsed)
+    return False
+
+class FileRangeIter(object):
+    """ Iterates over bytes `start` to `end` of the file `f` """
+    
+    def __init__(self, f, start, end, block_size=BLOCK_SIZE):
+        self.f = f
+        self.start = start
+        self.end = end
+        self.block_size = block_size
+    
+    def __iter__(self):
+        self.f.seek(self.start)
+        remaining = self.end - self.start
+        while remaining > 0:
+            chunk = self.f.read(min(self.block_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    
+    def close(self):
+        self.f.close()
+
+class MultipartIter(FileRangeIter):
+    """ Iterates over a multipart/byteranges body for `ranges` of `f` """
+    
+    def __init__(self, f, ranges, boundary, content_type, size, block_size=BLOCK_SIZE):
+        self.f = f
+        self.ranges = ranges
+        self.boundary = boundary
+        self.content_type = content_type
+        self.size = size
+        self.block_size = block_size
+    
+    def part_header(self, start, end):
+        return '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            self.boundary, self.content_type, start, end - 1, self.size)
+    
+    def __len__(self):
+        length = len('--%s--\r\n' % self.boundary)
+        for start, end in self.ranges:
+            length += len(self.part_header(start, end)) + end - start + 2
+        return length
+    
+    def __iter__(self):
+        for start, end in self.ranges:
+            yield self.part_header(start, end)
+            for chunk in FileRangeIter(self.f, start, end, self.block_size):
+                yield chunk
+            yield '\r\n'
+        yield '--%s--\r\n' % self.boundary
+
+class FileServer(object):
+    """ Serves the files below `document_root`
+    
+        >>> from webtest import TestApp
+        >>> from tempfile import mkdtemp
+        >>> root = mkdtemp()
+        >>> open(join(root, 'intro.mp4'), 'wb').write('0123456789')
+        >>> app = TestApp(FileServer(root))
+        >>> app.get('/intro.mp4').body
+        '0123456789'
+        >>> res = app.get('/intro.mp4', headers={'Range': 'bytes=2-4'})
+        >>> res.status, res.body, res.headers['Content-Range']
+        ('206 Partial Content', '234', 'bytes 2-4/10')
+        >>> etag = res.headers['ETag']
+        >>> res = app.get('/intro.mp4', headers={'If-None-Match': etag}, status=304)
+        >>> res = app.get('/intro.mp4', headers={'Range': 'bytes=2-4', 'If-Range': 'W/' + etag})
+        >>> res.status, res.body
+        ('200 OK', '0123456789')
+        >>> res = app.get('/intro.mp4', headers={'Range': 'bytes=0-2,4-6'})
+        >>> res.status, res.body
+        ('200 OK', '0123456789')
+        >>> res = app.get('/../intro.mp4', status=404)
+    """
+    
+    def __init__(self, document_root, cache_max_age=3600, stat_ttl=5, block_size=BLOCK_SIZE, max_stat_entries=4096, precompressed=False):
+        self.document_root = abspath(document_root)
+        self.cache_max_age = int(cache_max_age)
+        self.stat_ttl = float(stat_ttl)
+        self.block_size = int(block_size)
+        self.max_stat_entries = int(max_stat_entries)
+        self.precompressed = precompressed
+        self._stats = {}
+    
+    def resolve(self, path_info):
+        """ Returns the filesystem path for `path_info`, or None if it points
+            outside the document root
+        """
+        path = normpath(join(self.document_root, path_info.lstrip('/')))
+        if not path.startswith(self.document_root + sep):
+            return None
+        return path
+    
+    def stat(self, path):
+        """ Returns the (size, mtime, etag) of the file at `path`, or None if
+            there isn't one. Results are cached for `stat_ttl` seconds.
+        """
+        now = time()
+        cached = self._stats.get(path)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        try:
+            st = stat(path)
+        except OSError:
+            info = None
+        else:
+            if S_ISREG(st.st_mode):
+                info = (st.st_size, int(st.st_mtime), self.etag(path, st))
+            else:
+                info = None
+        if len(self._stats) >= self.max_stat_entries:
+            self._stats.clear()
+        self._stats[path] = (now + self.stat_ttl, info)
+        return info
+    
+    def cache_control(self, path):
+        return 'public, max-age=%d' % self.cache_max_age
+    
+    def etag(self, path, st):
+        """ Uses the content hash recorded at ingest when there is one, and
+            the size and modification time of the file otherwise
+        """
+        if isfile(path + ETAG_SUFFIX):
+            f = open(path + ETAG_SUFFIX)
+            try:
+                digest = f.read().strip()
+            finally:
+                f.close()
+            if digest:
+                return '"%s"' % digest
+        return '"%x-%x"' % (int(st.st_mtime), st.st_size)
+    
+    def range_applies(self, environ, etag, mtime):
+        if_range = environ.get('HTTP_IF_RANGE')
+        if not if_range:
+            return True
+        if if_range.startswith('W/'):
+            # If-Range needs a strong comparison, which weak validators fail
+            return False
+        if if_range.startswith('"'):
+            return if_range == etag
+        parsed = parsedate_tz(if_range)
+        return parsed is not None and mktime_tz(parsed) == mtime
+    
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'), ('Content-Length', '0')])
+            return []
+        path = self.resolve(environ.get('PATH_INFO', ''))
+        info = path and self.stat(path)
+        if not info:
+            body = 'Not Found'
+            start_response('404 Not Found', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+            return [body]
+        content_type = guess_type(path)[0] or 'application/octet-stream'
+        headers = [('Cache-Control', self.cache_control(path))]
+        if self.precompressed:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if accepts_encoding(environ.get('HTTP_ACCEPT_ENCODING'), 'gzip'):
+                compressed = self.stat(path + '.gz')
+                if compressed:
+                    path, info = path + '.gz', compressed
+                    headers.append(('Content-Encoding', 'gzip'))
+        size, mtime, etag = info
+        headers.extend([
+            ('ETag', etag),
+            ('Last-Modified', formatdate(mtime, usegmt=True)),
+            ('Accept-Ranges', 'bytes'),
+        ])
+        if not_modified(environ, etag, mtime):
+            start_response('304 Not Modified', headers)
+            return []
+        
+        ranges = None
+        if self.range_applies(environ, etag, mtime):
+            ranges = parse_range(environ.get('HTTP_RANGE'), size)
+        if ranges:
+            ranges = coalesce_ranges(ranges, size)
+        if ranges == []:
+            headers.append(('Content-Range', 'bytes */%d' % size))
+            headers.append(('Content-Length', '0'))
+            start_response('416 Requested Range Not Satisfiable', headers)
+            return []
+        
+        if method == 'HEAD':
+            f = None
+        else:
+            f = open(path, 'rb')
+        if not ranges:
+            headers.append(('Content-Type', content_type))
+            headers.append(('Content-Length', str(size)))
+            start_response('200 OK', headers)
+            if f is None:
+                return []
+            file_wrapper = environ.get('wsgi.file_wrapper')
+            if file_wrapper is not None:
+                return file_wrapper(f, self.block_size)
+            return FileRangeIter(f, 0, size, self.block_size)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers.append(('Content-Type', content_type))
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size)))
+            headers.append(('Content-Length', str(end - start)))
+            start_response('206 Partial Content', headers)
+            if f is None:
+                return []
+            return FileRangeIter(f, start, end, self.block_size)
+        boundary = md5('%s%s' % (random(), path)).hexdigest()
+        body = MultipartIter(f, ranges, boundary, content_type, size, self.block_size)
+        headers.append(('Content-Type', 'multipart/byteranges; boundary=%s' % boundary))
+        headers.append(('Content-Length', str(len(body))))
+        start_response('206 Partial Content', headers)
+        if f is None:
+            return []
+        return body
+
+def make_encodes_app(global_conf, document_root, cache_max_age=3600, stat_ttl=5, **kw):
+    """ paste.app_factory for serving the encodes in `document_root` """
+    return FileServer(document_root, cache_max_age=cache_max_age, stat_ttl=stat_ttl)
@@ -0,0 +1,225 @@
+""" Bulk import of videos from a manifest file
+
+    Manifests are either CSV files with a header row or JSON lines files
+    (one object per line, used when the filename ends in `.jsonl` or
+    `.json`). Each row has a `name`, `description`, `tags` and `encodes`:
+    
+        name,description,tags,encodes
+        Oil on Ice,Drilling in the arctic,"arctic,water",mp4=/masters/oil.mp4
+        
+        {"name": "Oil on Ice", "description": "Drilling in the arctic",
+         "tags": ["arctic", "water"], "encodes": {"mp4": "/masters/oil.mp4"}}
+    
+    Videos are committed in batches. After each commit the number of the
+    last imported row is written to a progress file, and a later run of the
+    same manifest carries on from there. The encodes of a row which fails,
+    or of a batch which doesn't get committed, are removed again.
+"""
+from optparse import OptionParser
+from os import rename
+from os.path import exists, join
+from shutil import rmtree
+from time import time
+import csv
+import logging
+import sys
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import transaction
+
+log = logging.getLogger('mint.repoze.importer')
+
+usage = '%prog [options] MANIFEST'
+
+def split_list(value):
+    """ Splits a comma separated CSV field into a list
+    
+        >>> split_list(u'arctic, water,')
+        [u'arctic', u'water']
+    """
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def split_encodes(value):
+    """ Splits a CSV `encodes` field of the form `mp4=/path;mov=/path`
+    
+        >>> sorted(split_encodes(u'mp4=/masters/oil.mp4; mov=/masters/oil.mov').items())
+        [(u'mov', u'/masters/oil.mov'), (u'mp4', u'/masters/oil.mp4')]
+    """
+    encodes = {}
+    for item in value.split(';'):
+        if '=' in item:
+            encode, path = item.split('=', 1)
+            encodes[encode.strip()] = path.strip()
+    return encodes
+
+def read_manifest(path):
+    """ Yields (row number, row) for each video in the manifest at `path` """
+    manifest = open(path, 'rb')
+    try:
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            for number, line in enumerate(manifest):
+                if line.strip():
+                    yield number + 1, json.loads(line)
+        else:
+            for number, row in enumerate(csv.DictReader(manifest)):
+                row = dict([(k, v.decode('utf-8')) for k, v in row.items() if v is not None])
+                row['tags'] = split_list(row.get('tags', u''))
+                row['encodes'] = split_encodes(row.get('encodes', u''))
+                yield number + 1, row
+    finally:
+        manifest.close()
+
+def read_progress(path):
+    if not exists(path):
+        return 0
+    progress = open(path)
+    try:
+        return int(progress.read().strip() or 0)
+    finally:
+        progress.close()
+
+def write_progress(path, number):
+    tmp = path + '.tmp'
+    progress = open(tmp, 'w')
+    try:
+        progress.write('%d\n' % number)
+    finally:
+        progress.close()
+    rename(tmp, path)
+
+def import_video(videos, row, written):
+    """ Adds the video described by `row` to `videos`, appending the
+        directory its encodes are stored in to `written` before any are
+    """
+    from mint.repoze import CONFIG
+    from mint.repoze.models import Video
+    streams = {}
+    try:
+        for encode, path in row.get('encodes', {}).items():
+            streams[encode] = open(path, 'rb')
+        uid = videos.make_uid(row['name'])
+        video_dir = CONFIG.get('video_dir', videos.encode_dir)
+        written.append(join(video_dir, uid))
+        videos[uid] = Video(uid, row['name'], row.get('description', u''), list(row.get('tags', [])), streams, video_dir)
+    finally:
+        for stream in streams.values():
+            stream.close()
+
+def remove_encodes(written):
+    """ Removes the encode directories in `written`, which belong to videos
+        that were rolled back
+    """
+    for directory in written:
+        rmtree(directory, ignore_errors=True)
+    del written[:]
+
+def import_manifest(videos, manifest, batch_size=100, progress=None):
+    """ Imports every row of `manifest` after the one recorded in the
+        `progress` file into `videos`, committing every `batch_size` rows.
+        Each row is added inside a savepoint, so a bad row is rolled back
+        and logged without losing the rest of its batch. If a commit fails
+        (or the import is interrupted) the batch is aborted, and the encodes
+        of every row rolled back are removed from the video directory.
+        
+        Returns a tuple of (imported, failed, seconds taken).
+    """
+    done = 0
+    if progress:
+        done = read_progress(progress)
+        if done:
+            log.info('resuming after row %s' % done)
+    imported = failed = pending = 0
+    started = batch_started = time()
+    last = done
+    # encode directories of the rows added since the last commit, and of
+    # the row being added
+    written = []
+    row_written = []
+    try:
+        for number, row in read_manifest(manifest):
+            if number <= done:
+                continue
+            savepoint = transaction.savepoint()
+            row_written = []
+            try:
+                import_video(videos, row, row_written)
+            except Exception:
+                savepoint.rollback()
+                remove_encodes(row_written)
+                failed += 1
+                log.exception('row %s could not be imported' % number)
+            else:
+                written.extend(row_written)
+                row_written = []
+                imported += 1
+            pending += 1
+            last = number
+            if pending >= batch_size:
+                transaction.commit()
+                del written[:]
+                if progress:
+                    write_progress(progress, last)
+                now = time()
+                log.info('committed %s rows up to row %s (%.1f rows/s)' % (pending, last, pending / max(now - batch_started, 1e-6)))
+                pending, batch_started = 0, now
+        if pending:
+            transaction.commit()
+            del written[:]
+            if progress:
+                write_progress(progress, last)
+    except:
+        transaction.abort()
+        remove_encodes(written + row_written)
+        raise
+    return imported, failed, time() - started
+
+def main(argv=sys.argv):
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', '--config', help='paste config file to read zodb_uri, zodb_base and video_dir from')
+    parser.add_option('-n', '--app-name', default='main', help='name of the app section in the config file [%default]')
+    parser.add_option('--zodb-uri', help='ZODB uri to import into')
+    parser.add_option('--zodb-base', help='name of the mint root in the database')
+    parser.add_option('--video-dir', help='directory encodes are stored in')
+    parser.add_option('-b', '--batch-size', type='int', default=100, help='number of rows per commit [%default]')
+    parser.add_option('-p', '--progress', help='file recording import progress [MANIFEST.progress]')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('a manifest file is required')
+    manifest = args[0]
+    
+    logging.basicConfig(level=logging.INFO)
+    settings = {}
+    if options.config:
+        from paste.deploy import appconfig
+        settings.update(appconfig('config:%s' % options.config, name=options.app_name, relative_to='.'))
+    for name in ('zodb_uri', 'zodb_base', 'video_dir'):
+        if getattr(options, name):
+            settings[name] = getattr(options, name)
+        if name not in settings:
+            parser.error('missing %s, use --config or --%s' % (name, name.replace('_', '-')))
+    
+    import mint.repoze
+    mint.repoze.CONFIG.update(settings)
+    from repoze.zodbconn.finder import dbfactory_from_uri
+    from mint.repoze.root import ZODBInit
+    db = dbfactory_from_uri(settings['zodb_uri'])()
+    conn = db.open()
+    try:
+        root = ZODBInit(settings['zodb_base'])(conn.root())
+        imported, failed, seconds = import_manifest(
+            root['videos'],
+            manifest,
+            batch_size=max(options.batch_size, 1),
+            progress=options.progress or manifest + '.progress',
+        )
+    finally:
+        conn.close()
+        db.close()
+    log.info('imported %s videos (%s failed) in %.1fs, %.1f videos/s' % (imported, failed, seconds, imported / max(seconds, 1e-6)))
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+""" Moving uploaded encodes into the video directory
+
+    Uploads have already been spooled to disk once by the time they reach
+    us, so `ingest` tries not to write them a second time. Forms parsed with
+    a `spooling_field_storage` spool their files into named temporary files
+    on the same filesystem as the encodes, and those are hard linked into
+    place. Anything else (including an importer's master files, which may
+    be edited later and mustn't share an inode with the published encode)
+    is copied in a single pass into a temporary file which is renamed over
+    the destination. Either way the md5 and size are worked out as it goes.
+"""
+from os import link, rename, unlink, rmdir, makedirs, fsync, fdopen, chmod
+from os.path import dirname, isdir, isfile, join
+from tempfile import mkstemp, mkdtemp, NamedTemporaryFile
+import cgi
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+import logging
+
+log = logging.getLogger('mint.repoze.ingest')
+
+BUFFER_SIZE = 1024 * 1024
+
+def spooling_field_storage(spool_dir):
+    """ Returns a cgi.FieldStorage class which spools uploaded files into
+        named temporary files in `spool_dir`, rather than anonymous ones,
+        so that `ingest` can link them into place. They are removed when
+        closed. (cgi.FieldStorage keeps files of under 1000 bytes in memory.)
+        
+        >>> from StringIO import StringIO
+        >>> from tempfile import mkdtemp
+        >>> crlf = chr(13) + chr(10)
+        >>> body = crlf.join(['--b', 'Content-Disposition: form-data; name="video.file"; filename="intro.mp4"',
+        ...                   '', 'video' * 1000, '--b--', ''])
+        >>> environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'multipart/form-data; boundary=b',
+        ...            'CONTENT_LENGTH': str(len(body))}
+        >>> FieldStorage = spooling_field_storage(mkdtemp())
+        >>> upload = FieldStorage(fp=StringIO(body), environ=environ)['video.file']
+        >>> source_path(upload.file) is not None, len(upload.file.read())
+        (True, 5000)
+    """
+    class SpoolingFieldStorage(cgi.FieldStorage):
+        def make_file(self, binary=None):
+            if not isdir(spool_dir):
+                makedirs(spool_dir)
+            f = NamedTemporaryFile('w+b', suffix='.upload', dir=spool_dir)
+            f.spooled = True
+            return f
+    return SpoolingFieldStorage
+
+def source_path(stream):
+    """ Returns the path of the upload spooled by `spooling_field_storage`
+        behind `stream`, or None if it isn't one
+        
+        >>> from StringIO import StringIO
+        >>> source_path(StringIO('data')) is None
+        True
+        >>> source_path(open(__file__.replace('.pyc', '.py'))) is None
+        True
+    """
+    if not getattr(stream, 'spooled', False):
+        return None
+    name = getattr(stream, 'name', None)
+    if isinstance(name, basestring) and isfile(name):
+        return name
+    return None
+
+def hash_file(path, buffer_size=BUFFER_SIZE):
+    """ Returns the (md5 hexdigest, size) of the file at `path` """
+    digest = md5()
+    size = 0
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest(), size
+
+def copy_stream(stream, dst, buffer_size=BUFFER_SIZE):
+    """ Copies `stream` to `dst` through a temporary file in the same
+        directory, renamed into place once it is complete. Returns the
+        (md5 hexdigest, size) of what was written.
+        
+        >>> from StringIO import StringIO
+        >>> from tempfile import mkdtemp
+        >>> from os import stat
+        >>> dst = join(mkdtemp(), 'intro', 'intro.mp4')
+        >>> copy_stream(StringIO('not really a video'), dst)
+        ('84559c0a072fe29a07f9ba50911b91bb', 18)
+        >>> open(dst).read(), oct(stat(dst).st_mode & 0777)
+        ('not really a video', '0644')
+    """
+    directory = dirname(dst)
+    if directory and not isdir(directory):
+        makedirs(directory)
+    fd, tmp = mkstemp(suffix='.tmp', dir=directory)
+    out = fdopen(fd, 'wb')
+    digest = md5()
+    size = 0
+    try:
+        while True:
+            chunk = stream.read(buffer_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+        out.flush()
+        fsync(out.fileno())
+        out.close()
+        # temporary files are only readable by their owner
+        chmod(tmp, 0644)
+        rename(tmp, dst)
+    except:
+        out.close()
+        unlink(tmp)
+        raise
+    return digest.hexdigest(), size
+
+def link_file(src, dst):
+    """ Hard links `src` to `dst`, replacing anything already at `dst`.
+        Raises OSError if the two aren't on the same filesystem.
+        
+        >>> from tempfile import mkdtemp
+        >>> from os import listdir
+        >>> root = mkdtemp()
+        >>> src, dst = join(root, 'upload'), join(root, 'intro', 'intro.mp4')
+        >>> open(src, 'wb').write('not really a video')
+        >>> link_file(src, dst)
+        >>> open(dst).read(), listdir(dirname(dst))
+        ('not really a video', ['intro.mp4'])
+    """
+    directory = dirname(dst)
+    if directory and not isdir(directory):
+        makedirs(directory)
+    # link() won't replace a file, so the link is made in a private
+    # directory (nobody else can pick its name) and renamed into place
+    tmp_dir = mkdtemp(suffix='.tmp', dir=directory)
+    tmp = join(tmp_dir, 'link')
+    try:
+        link(src, tmp)
+        try:
+            chmod(tmp, 0644)
+            rename(tmp, dst)
+        except:
+            unlink(tmp)
+            raise
+    finally:
+        rmdir(tmp_dir)
+
+def ingest(stream, dst, buffer_size=BUFFER_SIZE):
+    """ Puts the contents of `stream` at `dst`, hard linking the spooled
+        upload behind the stream when there is one on the same filesystem
+        and copying it otherwise. Returns the (md5 hexdigest, size) of the
+        result.
+    """
+    src = source_path(stream)
+    if src is not None:
+        try:
+            link_file(src, dst)
+        except OSError:
+            log.debug('could not link `%s` to `%s`, copying instead' % (src, dst))
+        else:
+            return hash_file(dst, buffer_size)
+    return copy_stream(stream, dst, buffer_size)
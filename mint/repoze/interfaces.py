@@ -32,7 +32,28 @@ class IVideoContainer(Interface):
     
     
     def get_videos_by_tag(tag):
-        """Return all contained Video objects which include `tag`"""
+        """Return a lazy sequence of contained Video objects which include `tag`, newest first"""
+    
+    def get_latest(limit=10, tag=None):
+        """Return the `limit` most recently published Video objects, optionally only those tagged `tag`"""
+    
+    def search(query, page=1, per_page=20):
+        """Return a page of contained Video objects matching `query`, best match first"""
+    
+
+class ISearchIndex(Interface):
+    
+    def index_video(video):
+        """Adds or refreshes the entries for `video`"""
+    
+    def unindex(uid):
+        """Removes any entries stored against `uid`"""
+    
+    def search(query):
+        """Returns a list of (uid, score) pairs matching `query`, best first"""
+    
+    def queue(video):
+        """Schedules `video` to be indexed when the current transaction commits"""
     
 
 class IChannel(Interface):
@@ -49,6 +70,9 @@ class IChannelContainer(Interface):
     def is_stored(key):
         """Returns whether a channel is stored in the database as a boolean value"""
     
+    def get_stings(tags):
+        """Returns lists of the pre and end rolls of the channels for `tags`"""
+    
 
 class IAdvert(Interface):
     
@@ -77,7 +101,16 @@ class IAdSpaceContainer(Interface):
 class IUser(Interface):
     id = TextLine(title=u"User ID")
     email = TextLine(title=u"User email address")
-    password = TextLine(title=u"User password")
+    password = TextLine(title=u"Hash of the user's password")
+    
+    def set_groups(groups):
+        """Sets the groups the user belongs to"""
+    
+    def set_password(password):
+        """Stores a hash of `password`"""
+    
+    def check_password(password):
+        """Returns whether `password` is the user's password"""
 
 class IUserContainer(Interface):
     def add_user(id, *args, **kwargs):
@@ -85,10 +118,19 @@ class IUserContainer(Interface):
 
 class ISyndication(Interface):
     def get_listings():
-        """Returns an iterable of items to be used in a syndication feed"""
+        """Returns a lazy, sliceable sequence of items to be used in a syndication feed"""
+    
+    def get_page(page=1, per_page=20):
+        """Returns a single page of the listings, numbered from 1"""
     
     def get_metadata():
         """Returns a mapping of key/value pairs reflecting generic channel metadata"""
+    
+    def get_feed_version():
+        """Returns the newest item's sort key and a tuple of serials, which between them change whenever the feed does"""
+    
+    def get_feed_objects():
+        """Returns the persistent objects whose serials get_feed_version reports"""
 
 class IStingable(Interface):
     def get_playlist(additional_pre=[], additional_post=[]):
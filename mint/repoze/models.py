@@ -6,6 +6,8 @@ try:
 except ImportError:
     from md5 import md5
 from datetime import datetime
+from time import mktime
+import struct
 
 from zope.interface import implements, Interface
 from zope.interface.interfaces import IInterface
@@ -15,16 +17,38 @@ from repoze.bfg.traversal import model_path_tuple
 from persistent import Persistent
 from persistent.mapping import PersistentMapping
 from persistent.dict import PersistentDict
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.OIBTree import OIBTree
+from BTrees.Length import Length
 
 from mint.repoze.interfaces import IVideo, IVideoContainer
 from mint.repoze.interfaces import IChannel, IChannelContainer
 from mint.repoze.interfaces import IAdvert, IAdSpace, IAdSpaceContainer
 from mint.repoze.interfaces import IUser, IUserContainer
 from mint.repoze.interfaces import ISyndication, IStingable
+from mint.repoze.search import SearchIndex
+from mint.repoze.ingest import ingest, BUFFER_SIZE
+from mint.repoze.mp4 import probe, faststart, MP4Error
+from mint.repoze.fileserver import write_etag
+from mint.repoze.feeds import feed_publisher
+from mint.repoze.cache import groups_cache
+from mint.repoze import passwords
 from mint.repoze import CONFIG
 
 import logging
 
+# the encodes a podcast enclosure may point to, most preferred first, and
+# their types for when probing couldn't tell
+ENCLOSURE_TYPES = (
+    ('m4v', u'video/x-m4v'),
+    ('mp4', u'video/mp4'),
+    ('mov', u'video/quicktime'),
+)
+
+# the encodes stored in MP4 or QuickTime files, which can be probed and
+# have their `moov` box moved to the front
+MP4_ENCODES = ('mp4', 'm4v', 'mov')
+
 class AssertingList(list):
     """ A convenience class to assert added objects provide a specified interface
         
@@ -142,6 +166,17 @@ class BaseContainer(PersistentMapping):
         except: pass
         return ret
     
+    def __delitem__(self, key):
+        """ Removes `key` from the underlying self.data mapping
+            
+            >>> container = BaseContainer()
+            >>> container['foo'] = 'bar'
+            >>> del container['foo']
+            >>> 'foo' in container.data
+            False
+        """
+        return self.data.__delitem__(key)
+    
     def items(self):
         return self.data.items()
     
@@ -182,6 +217,179 @@ class BaseContainer(PersistentMapping):
                 self.__setitem__(k,v)
             
 
+class BTreeContainer(BaseContainer):
+    """ A BaseContainer which stores its children in an OOBTree along with a
+        conflict-free length counter, so adding a child only rewrites the
+        buckets it touches and concurrent additions don't conflict.
+        
+        >>> container = BTreeContainer()
+        >>> container[u'foo'] = u'bar'
+        >>> container[u'foo']
+        u'bar'
+        >>> len(container)
+        1
+        >>> container[u'foo'] = u'baz'
+        >>> len(container)
+        1
+        >>> container.items()
+        [(u'foo', u'baz')]
+        >>> container.keys()
+        [u'foo']
+        >>> container.values()
+        [u'baz']
+        >>> del container[u'foo']
+        >>> len(container)
+        0
+        
+    """
+    _length = None
+    
+    def __init__(self):
+        self.data = OOBTree()
+        self._length = Length()
+    
+    def __setitem__(self, key, value):
+        if key not in self.data:
+            self._length.change(1)
+        return super(BTreeContainer, self).__setitem__(key, value)
+    
+    def __delitem__(self, key):
+        ret = super(BTreeContainer, self).__delitem__(key)
+        self._length.change(-1)
+        return ret
+    
+    def __len__(self):
+        if self._length is None:
+            return len(self.data)
+        return self._length()
+    
+    def items(self):
+        return list(self.data.items())
+    
+    def keys(self):
+        return list(self.data.keys())
+    
+    def values(self):
+        return list(self.data.values())
+    
+    def migrate_data(self):
+        """ Moves the children of containers created before BTree storage
+            into an OOBTree. Returns True if anything needed moving.
+            
+            >>> container = BTreeContainer()
+            >>> container.data, container._length = PersistentDict({u'foo': u'bar'}), None
+            >>> container.migrate_data()
+            True
+            >>> isinstance(container.data, OOBTree), len(container)
+            (True, 1)
+            >>> container.migrate_data()
+            False
+        """
+        if isinstance(self.data, OOBTree) and self._length is not None:
+            return False
+        data = OOBTree()
+        data.update(self.data.items())
+        self.data = data
+        self._length = Length(len(data))
+        return True
+    
+
+class Listing(object):
+    """ A lazy, sliceable sequence of objects held in `container`. Only the
+        keys are kept; objects are looked up as they are indexed or iterated
+        (through `resolve` when the keys aren't the container's own), and
+        slicing returns another Listing without loading anything.
+        
+        >>> container = BTreeContainer()
+        >>> container.update({u'a': 1, u'b': 2, u'c': 3})
+        >>> listing = Listing(container, container.data.keys(), len(container))
+        >>> len(listing)
+        3
+        >>> listing[0]
+        1
+        >>> list(listing[1:])
+        [2, 3]
+        >>> list(listing[:-1])
+        [1, 2]
+        
+    """
+    def __init__(self, container, keys, length=None, resolve=None):
+        self.container = container
+        self.keys = keys
+        self._length = length
+        self.resolve = resolve
+    
+    def __len__(self):
+        if self._length is None:
+            self._length = len(self.keys)
+        return self._length
+    
+    def __iter__(self):
+        for key in self.keys:
+            yield self._lookup(key)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('Listings only support contiguous slices')
+            stop = max(start, stop)
+            return Listing(self.container, self.keys[start:stop], stop - start, self.resolve)
+        return self._lookup(self.keys[index])
+    
+    def _lookup(self, key):
+        if self.resolve is None:
+            return self.container[key]
+        return self.resolve(key)
+    
+    def page(self, number=1, per_page=20):
+        """ Returns the `Page` numbered `number` (counting from 1)
+            
+            >>> container = BTreeContainer()
+            >>> container.update(dict([(u'%02d' % i, i) for i in range(5)]))
+            >>> page = Listing(container, container.data.keys()).page(2, 2)
+            >>> list(page.items)
+            [2, 3]
+            >>> page.previous, page.next, page.pages
+            (1, 3, 3)
+        """
+        return Page(self, number, per_page)
+    
+
+class Page(object):
+    """ A single page of a `Listing` along with the numbers needed to link to
+        its neighbours. Pages past the end are empty rather than an error.
+        
+        >>> container = BTreeContainer()
+        >>> container.update(dict([(u'%02d' % i, i) for i in range(5)]))
+        >>> page = Page(Listing(container, container.data.keys()), 3, 2)
+        >>> list(page.items), page.previous, page.next
+        ([4], 2, None)
+        >>> list(Page(page.listing, 4, 2).items)
+        []
+    """
+    def __init__(self, listing, number=1, per_page=20):
+        self.listing = listing
+        self.number = max(int(number), 1)
+        self.per_page = max(int(per_page), 1)
+        self.total = len(listing)
+        self.pages = (self.total + self.per_page - 1) // self.per_page
+        offset = (self.number - 1) * self.per_page
+        self.items = listing[offset:offset + self.per_page]
+    
+    @property
+    def previous(self):
+        if self.number > 1:
+            return self.number - 1
+        return None
+    
+    @property
+    def next(self):
+        if self.number < self.pages:
+            return self.number + 1
+        return None
+    
+
 class SyndicationMetadata(dict):
     def __init__(self, _dict=None, **kwargs):
         self.update({
@@ -205,10 +413,19 @@ class SyndicationMetadata(dict):
 ## Models
 
 class Encode(Persistent):
+    """ A single encode of a video stored on the filesystem
+        
+        >>> from StringIO import StringIO
+        >>> from tempfile import mkdtemp
+        >>> path = join(mkdtemp(), u'intro', u'intro.mp4')
+        >>> encode = Encode(u'mp4', StringIO('not really a video'), path)
+        >>> encode.metadata['size'], encode.metadata['md5']
+        (18, '84559c0a072fe29a07f9ba50911b91bb')
+    """
     
     __name__ = __parent__ = None
     
-    def __init__(self, encode='mp4', stream=None, path=None, buffer_size=16384):
+    def __init__(self, encode='mp4', stream=None, path=None, buffer_size=BUFFER_SIZE):
         self.__name__ = encode
         self.path = path
         
@@ -219,26 +436,50 @@ class Encode(Persistent):
             'bitrate': 0,
             'width': 0,
             'height': 0,
+            'md5': '',
+            'faststart': False,
         }
         
         if stream:
             self.save(stream, buffer_size)
     
-    def save(self, stream, buffer_size=16384):
+    def save(self, stream, buffer_size=BUFFER_SIZE):
+        """ Stores the contents of `stream` at self.path in a single pass
+            (see `mint.repoze.ingest`), recording its size and md5. MP4 and
+            QuickTime encodes (those in MP4_ENCODES) have their `moov` box
+            moved to the front (see `mint.repoze.mp4.faststart`) and their
+            duration, dimensions and bitrate recorded too; other formats are
+            stored as they are. The md5 is also written beside the file for
+            `mint.repoze.fileserver` to use as its ETag.
+            
+            >>> from StringIO import StringIO
+            >>> from tempfile import mkdtemp
+            >>> encode = Encode(u'webm', StringIO('not really a video'), join(mkdtemp(), u'intro.webm'))
+            >>> encode.metadata['faststart'], encode.metadata['md5']
+            (False, '84559c0a072fe29a07f9ba50911b91bb')
+        """
         if self.path is None:
             self.path = join(CONFIG['video_dir'], self.__name__, '%s.%s' % (self.__name__, self.__name__))
-        if not isinstance(dst, basestring):
-            raise TypeError('Destination should be a string not a %s' % type(dst))
-        dst_file = file(self.path, 'wb')
-        try:
-            copyfileobj(stream, dst_file, buffer_size)
-        except:
-            dst_file.close()
-            return None
-        else:
-            dst_file.close()
-            ##TODO: gather extra info - length/dims/bitrate etc
-            return dst
+        if not isinstance(self.path, basestring):
+            raise TypeError('Destination should be a string not a %s' % type(self.path))
+        digest, size = ingest(stream, self.path, buffer_size)
+        self.metadata['md5'] = digest
+        self.metadata['size'] = size
+        if self.__name__ in MP4_ENCODES:
+            log = logging.getLogger('mint.repoze.models')
+            try:
+                self.metadata['faststart'], rewritten = faststart(self.path, buffer_size)
+                if rewritten:
+                    self.metadata['md5'] = rewritten
+            except (MP4Error, IOError, struct.error):
+                log.warning('could not move the moov box of `%s` to the front' % self.path)
+            try:
+                self.metadata.update(probe(self.path))
+            except (MP4Error, IOError, struct.error):
+                log.warning('could not read metadata from `%s`' % self.path)
+        write_etag(self.path, self.metadata['md5'])
+        self._p_changed = True
+        return self.path
     
 
 class Video(BaseContainer):
@@ -295,7 +536,8 @@ class Video(BaseContainer):
         except OSError:
             pass
         for k,v in encodes.items():
-            self.__setitem__(k, Encode(k,v))
+            path = join(self.static_dir, self.__name__, '%s.%s' % (self.__name__, k))
+            self.__setitem__(k, Encode(k, v, path))
     
     def __repr__(self):
         return u'<Video name=%s>' % self.name
@@ -304,6 +546,18 @@ class Video(BaseContainer):
     def encodes(self):
         return self.data
     
+    def get_encode_metadata(self, encode='mp4'):
+        """ Returns the metadata recorded for `encode`, or an empty set of
+            metadata if there is no such encode
+            
+            >>> ob = Video(uid=u'video1', name=u'Video 1', description=u'description')
+            >>> ob.get_encode_metadata()['length']
+            0
+        """
+        if encode in self.data:
+            return self.data[encode].metadata
+        return Encode(encode).metadata
+    
     def get_path_to_encode(self, encode='mp4'):
         ##TODO: dynamic url to static
         base_url = CONFIG['base_url']
@@ -314,6 +568,30 @@ class Video(BaseContainer):
         name = self.__name__
         return u'%(base)s/%(name)s/%(name)s.%(encode)s' % locals()
     
+    def get_enclosure(self):
+        """ Returns the url, length, type and duration of the encode a podcast
+            should link to, all taken from that one encode
+            
+            >>> from StringIO import StringIO
+            >>> from tempfile import mkdtemp
+            >>> ob = Video(u'video1', u'Video 1', u'description', encodes={'mp4': StringIO('video')}, static_dir=mkdtemp())
+            >>> enclosure = ob.get_enclosure()
+            >>> enclosure['url'], enclosure['length'], enclosure['type']
+            (u'http://localhost:6543/videos/video1/video1.mp4', 5, u'video/mp4')
+        """
+        for encode, mimetype in ENCLOSURE_TYPES:
+            if encode in self.data:
+                break
+        else:
+            encode, mimetype = ENCLOSURE_TYPES[1]
+        metadata = self.get_encode_metadata(encode)
+        return {
+            'url': self.get_path_to_encode(encode),
+            'length': metadata['size'],
+            'type': metadata['mimetype'] or mimetype,
+            'duration': metadata['length'],
+        }
+    
     def get_playlist(self, pre=[], post=[]):
         """ Returns a list of videos to play including pre/end rolls
             
@@ -349,7 +627,7 @@ class Video(BaseContainer):
         return playlist
     
 
-class VideoContainer(BaseContainer):
+class VideoContainer(BTreeContainer):
     """ A simple container for Video objects
         
         >>> from mint.repoze.interfaces import IVideoContainer
@@ -380,9 +658,21 @@ class VideoContainer(BaseContainer):
     encode_dir = 'var/videos/'
     pre_roll = u''
     end_roll = u''
+    tag_index = None
+    date_index = None
+    search_index = None
+    changes = None
+    _slug_counters = None
     
     def __init__(self, *args, **kwargs):
         super(VideoContainer, self).__init__()
+        self.tag_index = OOBTree()
+        self.date_index = OOTreeSet()
+        self._indexed_tags = OOBTree()
+        self._sort_keys = OOBTree()
+        self._slug_counters = OIBTree()
+        self.search_index = SearchIndex()
+        self.changes = Length()
         for data in args:
             self.add_video(*data)
         for v in kwargs.values():
@@ -392,8 +682,272 @@ class VideoContainer(BaseContainer):
     def __repr__(self):
         return u'<VideoContainer object>'
     
+    def __setitem__(self, key, value):
+        """ Stores `value` and adds any Video objects to the indexes
+            
+            >>> ob = VideoContainer()
+            >>> ob[u'vid1'] = Video(u'vid1', u'Video 1', u'description', [u'foo', u'bar'])
+            >>> [uid for date, uid in ob.tag_index[u'foo']]
+            [u'vid1']
+        """
+        ret = super(VideoContainer, self).__setitem__(key, value)
+        if IVideo.providedBy(value):
+            self.index_video(value)
+        return ret
+    
+    def __delitem__(self, key):
+        """ Removes the video stored at `key` along with its index entries
+            
+            >>> ob = VideoContainer()
+            >>> ob[u'vid1'] = Video(u'vid1', u'Video 1', u'description', [u'foo'])
+            >>> del ob[u'vid1']
+            >>> u'foo' in ob.tag_index, len(ob.date_index)
+            (False, 0)
+        """
+        self.unindex_video(key)
+        return super(VideoContainer, self).__delitem__(key)
+    
+    def sort_key(self, video):
+        """ Returns the key `video` is stored under in the date ordered
+            indexes. Keys sort newest first, then by uid.
+            
+            >>> ob = VideoContainer()
+            >>> old = Video(u'old', u'Old', u'description')
+            >>> old.published_date = datetime(2009, 1, 1)
+            >>> new = Video(u'new', u'New', u'description')
+            >>> new.published_date = datetime(2009, 6, 1)
+            >>> ob.sort_key(new) < ob.sort_key(old)
+            True
+        """
+        published = video.published_date
+        timestamp = mktime(published.timetuple()) + published.microsecond / 1e6
+        return (-timestamp, video.__name__)
+    
+    def index_video(self, video):
+        """ Adds (or refreshes) the tag and date index entries for `video`
+            and queues it for the search index. This needs calling whenever
+            the name, description or tags of a stored video are changed
+            
+            >>> ob = VideoContainer()
+            >>> ob[u'vid1'] = Video(u'vid1', u'Video 1', u'description', [u'foo'])
+            >>> ob[u'vid1'].tags = [u'bar']
+            >>> ob.index_video(ob[u'vid1'])
+            >>> u'foo' in ob.tag_index
+            False
+            >>> [uid for date, uid in ob.tag_index[u'bar']]
+            [u'vid1']
+        """
+        uid = video.__name__
+        self.unindex_video(uid)
+        key = self.sort_key(video)
+        tags = []
+        for tag in video.tags:
+            if tag not in tags:
+                tags.append(tag)
+        for tag in tags:
+            keys = self.tag_index.get(tag)
+            if keys is None:
+                keys = self.tag_index[tag] = OOTreeSet()
+            keys.insert(key)
+        self.date_index.insert(key)
+        self._indexed_tags[uid] = tuple(tags)
+        self._sort_keys[uid] = key
+        if self.search_index is not None:
+            self.search_index.queue(video)
+        self.record_change(tags)
+    
+    def unindex_video(self, uid):
+        """ Removes any index entries stored against `uid` """
+        key = self._sort_keys.get(uid)
+        if key is None:
+            return
+        self.record_change(self._indexed_tags.get(uid, ()))
+        if self.search_index is not None:
+            self.search_index.queue_removal(uid)
+        for tag in self._indexed_tags.get(uid, ()):
+            keys = self.tag_index.get(tag)
+            if keys is None:
+                continue
+            if key in keys:
+                keys.remove(key)
+            if not keys:
+                del self.tag_index[tag]
+        if key in self.date_index:
+            self.date_index.remove(key)
+        del self._indexed_tags[uid]
+        del self._sort_keys[uid]
+    
+    def reindex(self):
+        """ Rebuilds the tag and date indexes from scratch
+            
+            >>> ob = VideoContainer()
+            >>> ob[u'vid1'] = Video(u'vid1', u'Video 1', u'description', [u'foo'])
+            >>> ob.tag_index = ob.date_index = None
+            >>> ob.reindex()
+            >>> [uid for date, uid in ob.tag_index[u'foo']]
+            [u'vid1']
+        """
+        self.tag_index = OOBTree()
+        self.date_index = OOTreeSet()
+        self._indexed_tags = OOBTree()
+        self._sort_keys = OOBTree()
+        for video in self.data.values():
+            if IVideo.providedBy(video):
+                self.index_video(video)
+    
+    def record_change(self, tags=()):
+        """ Notes that a video with `tags` has been added, edited or
+            removed, and queues the feeds it appears in to be published.
+            `changes` is a BTrees.Length, so concurrent changes don't
+            conflict.
+        """
+        if self.changes is not None:
+            self.changes.change(1)
+        root = self.__parent__
+        if root is not None:
+            feed_publisher.queue(root, ('videos',))
+            for tag in tags:
+                feed_publisher.queue(root, ('channels', tag))
+    
+    def get_feed_version(self, tag=None):
+        """ Returns the sort key of the newest video (tagged with `tag`, if
+            given) and a tuple of serials which change along with the feed,
+            without loading any Video objects
+            
+            >>> ob = VideoContainer()
+            >>> ob[u'vid1'] = Video(u'vid1', u'Video 1', u'description', [u'foo'])
+            >>> newest, serials = ob.get_feed_version()
+            >>> newest[1], ob.get_feed_version(u'bar')[0]
+            (u'vid1', None)
+        """
+        if tag is None:
+            index = self.date_index
+        else:
+            index = self.tag_index.get(tag)
+        newest = None
+        if index is not None:
+            try:
+                newest = index.minKey()
+            except ValueError:
+                pass
+        serials = ()
+        for ob in self.get_feed_objects():
+            # otherwise a ghost (or invalidated) object reports a stale serial
+            ob._p_activate()
+            serials += (ob._p_serial,)
+        return newest, serials
+    
+    def get_feed_objects(self):
+        """ Returns the persistent objects whose serials make up the feed
+            version, itself and the `changes` counter
+        """
+        if self.changes is None:
+            return (self,)
+        return (self, self.changes)
+    
+    def _video_for_key(self, key):
+        return self.data[key[1]]
+    
+    def get_videos_by_tag(self, tag):
+        """ Returns a `Listing` of the Video objects tagged with `tag`, newest
+            first, using the tag index so only the matching videos are loaded
+            
+            >>> ob = VideoContainer()
+            >>> for i, tags in enumerate([[u'foo', u'bar'], [u'bar']]):
+            ...     video = Video(u'vid%s' % i, u'Video %s' % i, u'description', tags)
+            ...     video.published_date = datetime(2009, 1, i + 1)
+            ...     ob[video.__name__] = video
+            >>> list(ob.get_videos_by_tag(u'foo'))
+            [<Video name=Video 0>]
+            >>> list(ob.get_videos_by_tag(u'bar'))
+            [<Video name=Video 1>, <Video name=Video 0>]
+            >>> list(ob.get_videos_by_tag(u'baz'))
+            []
+        """
+        keys = self.tag_index.get(tag)
+        if keys is None:
+            return Listing(self, (), 0)
+        return Listing(self, keys.keys(), resolve=self._video_for_key)
+    
+    def get_latest(self, limit=10, tag=None):
+        """ Returns the `limit` most recently published videos, optionally
+            only those tagged with `tag`. Only `limit` index entries are read.
+            
+            >>> ob = VideoContainer()
+            >>> for i in range(5):
+            ...     video = Video(u'vid%s' % i, u'Video %s' % i, u'description', [u'foo'])
+            ...     video.published_date = datetime(2009, 1, i + 1)
+            ...     ob[video.__name__] = video
+            >>> list(ob.get_latest(2))
+            [<Video name=Video 4>, <Video name=Video 3>]
+            >>> list(ob.get_latest(2, tag=u'foo'))
+            [<Video name=Video 4>, <Video name=Video 3>]
+        """
+        if tag is None:
+            listing = self.get_listings()
+        else:
+            listing = self.get_videos_by_tag(tag)
+        return listing[:limit]
+    
+    def _video_for_result(self, result):
+        return self.data[result[0]]
+    
+    def search(self, query, page=1, per_page=20):
+        """ Returns a `Page` of the videos matching every word of `query`,
+            best match first. Each key of `page.items.keys` is a (uid, score)
+            pair.
+            
+            >>> ob = VideoContainer()
+            >>> ob[u'vid1'] = Video(u'vid1', u'Oil on Ice', u'Drilling in the arctic', [u'arctic'])
+            >>> ob[u'vid2'] = Video(u'vid2', u'Melting', u'Melting ice', [u'arctic'])
+            >>> import transaction
+            >>> transaction.commit()
+            >>> list(ob.search(u'ice arctic').items)
+            [<Video name=Oil on Ice>, <Video name=Melting>]
+            >>> ob.search(u'penguins').total
+            0
+        """
+        results = self.search_index.search(query)
+        return Listing(self, results, len(results), self._video_for_result).page(page, per_page)
+    
+    def make_uid(self, name):
+        """ Returns a unique id for a video called `name`. The first video
+            with a name gets its slug (lowercased, spaces replaced with
+            underscores) as its id; later ones get the slug followed by
+            `_001`, `_002` and so on. A per-slug counter means this is
+            normally a single lookup however many duplicates exist.
+            
+            >>> ob = VideoContainer()
+            >>> ob.make_uid(u'Intro Video')
+            u'intro_video'
+            >>> ob.make_uid(u'Intro Video')
+            u'intro_video_001'
+            >>> ob.make_uid(u'intro video')
+            u'intro_video_002'
+            
+            Ids taken some other way are skipped over:
+            
+            >>> ob[u'clip_001'] = Video(u'clip_001', u'Clip 001', u'description')
+            >>> ob.make_uid(u'Clip'), ob.make_uid(u'Clip')
+            (u'clip', u'clip_002')
+        """
+        if self._slug_counters is None:
+            self._slug_counters = OIBTree()
+        slug = name.lower().replace(' ', '_')
+        count = self._slug_counters.get(slug, 0)
+        uid = slug
+        if count:
+            uid = u'%s_%03d' % (slug, count)
+        while uid in self.data:
+            count += 1
+            uid = u'%s_%03d' % (slug, count)
+        self._slug_counters[slug] = count + 1
+        return uid
+    
     def add_video(self, name, description, tags, encodes={}):
-        """ Adds a video to the container
+        """ Adds a video to the container. Committing is left to the caller
+            so that many videos can be added in one transaction.
+            
             >>> video_container = VideoContainer()
             >>> video_container.add_video(u'new_video', u'A new video', [u'news'])
             >>> u'new_video' in video_container.data
@@ -402,28 +956,28 @@ class VideoContainer(BaseContainer):
             >>> u'new_video_001' in video_container.data
             True
         """
-        uid = name.lower().replace(' ', '_')
-        counter = 1
-        while uid in self:
-            uid = '%s_%03d' % (uid, counter)
-            counter += 1
-        self.__setitem__(uid, Video(uid, name, description, tags, encodes, self.encode_dir))
-        import transaction
-        transaction.commit()
+        uid = self.make_uid(name)
+        self.__setitem__(uid, Video(uid, name, description, tags, encodes, CONFIG.get('video_dir', self.encode_dir)))
     
     def get_listings(self):
-        """ Returns an iterable of Video objects to be used in a syndication feed
+        """ Returns a lazy `Listing` of Video objects to be used in a
+            syndication feed, newest first
             
             >>> from mint.repoze.test.data import video_container
             >>> listings = video_container.get_listings()
-            >>> listings[0] == video_container.data.values()[0]
+            >>> listings[0] in video_container.data.values()
+            True
+            >>> len(listings[1:]) == len(video_container) - 1
             True
         """
-        videos = self.data
-        return [video for video in videos.values() if IVideo.providedBy(video)]
+        return Listing(self, self.date_index.keys(), len(self), self._video_for_key)
+    
+    def get_page(self, page=1, per_page=20):
+        """ Returns one `Page` of the listings """
+        return self.get_listings().page(page, per_page)
     
     def get_playlist(self, pre=[], post=[]):
-        playlist = self.get_listings()
+        playlist = list(self.get_listings())
         if self.pre_roll:
             if CONFIG.get('add_parent_stings') == 'after':
                 pre = [self.pre_roll] + pre
@@ -464,7 +1018,20 @@ class Channel(Persistent):
     def get_listings(self):
         from mint.repoze.root import utility_finder
         videos = utility_finder(self, 'videos')
-        return [video for video in videos.values() if self.__name__ in video.tags]
+        return videos.get_videos_by_tag(self.__name__)
+    
+    def get_page(self, page=1, per_page=20):
+        return self.get_listings().page(page, per_page)
+    
+    def get_feed_version(self):
+        from mint.repoze.root import utility_finder
+        videos = utility_finder(self, 'videos')
+        newest, serials = videos.get_feed_version(self.__name__)
+        return newest, serials + (self._p_serial,)
+    
+    def get_feed_objects(self):
+        from mint.repoze.root import utility_finder
+        return utility_finder(self, 'videos').get_feed_objects() + (self,)
     
     def __repr__(self):
         return u'<Channel object>'
@@ -486,7 +1053,7 @@ class Channel(Persistent):
         return playlist
     
 
-class ChannelContainer(BaseContainer):
+class ChannelContainer(BTreeContainer):
     __acl__ = [
         (Allow, Everyone, 'view'),
         (Allow, 'admin', 'add'),
@@ -496,9 +1063,69 @@ class ChannelContainer(BaseContainer):
     implements(IChannelContainer, ILocation)
     
     __name__ = __parent__ = None
+    stings = None
     
     def __init__(self, *args, **kwargs):
         super(ChannelContainer, self).__init__()
+        self.stings = OOBTree()
+    
+    def __setitem__(self, key, value):
+        ret = super(ChannelContainer, self).__setitem__(key, value)
+        self.update_stings(value)
+        return ret
+    
+    def __delitem__(self, key):
+        ret = super(ChannelContainer, self).__delitem__(key)
+        if key in self.stings:
+            del self.stings[key]
+        return ret
+    
+    def update_stings(self, channel):
+        """ Records the pre and end rolls of the stored `channel` in `stings`,
+            which maps each tag with a sting to a (pre_roll, end_roll) pair
+        """
+        stings = (channel.pre_roll, channel.end_roll)
+        if channel.pre_roll or channel.end_roll:
+            if self.stings.get(channel.__name__) != stings:
+                self.stings[channel.__name__] = stings
+        elif channel.__name__ in self.stings:
+            del self.stings[channel.__name__]
+    
+    def rebuild_stings(self):
+        """ Rebuilds `stings` from the stored channels """
+        self.stings = OOBTree()
+        for channel in self.data.values():
+            self.update_stings(channel)
+    
+    def get_stings(self, tags):
+        """ Returns the pre and end rolls of the channels for `tags`, in order,
+            without loading the channels themselves
+            
+            >>> container = ChannelContainer()
+            >>> channel = Channel(u'arctic')
+            >>> channel.pre_roll = u'intro'
+            >>> container[u'arctic'] = channel
+            >>> container[u'water'] = Channel(u'water')
+            >>> container.get_stings([u'water', u'arctic', u'feature'])
+            ([u'intro'], [])
+            >>> channel.pre_roll, channel.end_roll = u'', u'outro'
+            >>> container.update_stings(channel)
+            >>> container.get_stings([u'water', u'arctic'])
+            ([], [u'outro'])
+            >>> del container[u'arctic']
+            >>> container.get_stings([u'arctic'])
+            ([], [])
+        """
+        pre = []
+        post = []
+        for tag in tags:
+            stings = self.stings.get(tag)
+            if stings is not None:
+                if stings[0]:
+                    pre.append(stings[0])
+                if stings[1]:
+                    post.append(stings[1])
+        return pre, post
     
     def __getitem__(self, key):
         try:
@@ -632,7 +1259,7 @@ class AdSpace(BaseContainer):
     
 
 
-class AdSpaceContainer(BaseContainer):
+class AdSpaceContainer(BTreeContainer):
     """ A simple container for storing advert and banner objects
         
         >>> from mint.repoze.interfaces import IAdSpaceContainer
@@ -653,7 +1280,7 @@ class AdSpaceContainer(BaseContainer):
         uid = title.lower().replace(' ', '_')
         ob = AdSpace(title, height, width, allowed_formats, adverts, static_dir)
         ob.__name__ = uid
-        self.data[uid] = ob
+        self[uid] = ob
     
 
 class User(Persistent):
@@ -667,10 +1294,19 @@ class User(Persistent):
         >>> ob.email == u'foo@bar.com'
         True
         >>> ob.password == u'secret'
-        True
+        False
+        >>> ob.check_password(u'secret'), ob.check_password(u'guess')
+        (True, False)
         >>> IUser.providedBy(ob)
         True
         
+        Users stored with a plain text password get a hash the next time
+        they log in:
+        
+        >>> ob.password = u'secret'
+        >>> ob.check_password(u'secret'), ob.password.startswith('pbkdf2_sha256$')
+        (True, True)
+        
     """
     __acl__ = [
             (Allow, Everyone, 'view'),
@@ -682,11 +1318,31 @@ class User(Persistent):
     def __init__(self, id, email, password):
         self.id = id
         self.email = email
-        self.password = password
+        self.set_password(password)
         self.groups = []
     
+    def set_groups(self, groups):
+        """ Sets the user's groups. Use this rather than changing `groups`,
+            so that the copy in `groups_cache` is dropped.
+        """
+        self.groups = list(groups)
+        groups_cache.delete_on_commit(self.id)
+    
+    def set_password(self, password):
+        self.password = passwords.hash_password(password)
+    
+    def check_password(self, password):
+        """ Whether `password` is right, rehashing it if the stored hash is
+            out of date
+        """
+        if not passwords.check_password(password, self.password):
+            return False
+        if passwords.needs_upgrade(self.password):
+            self.set_password(password)
+        return True
+    
 
-class UserContainer(BaseContainer):
+class UserContainer(BTreeContainer):
     """ A simple container for Users
         
         >>> from mint.repoze.interfaces import IUserContainer
@@ -715,12 +1371,21 @@ class UserContainer(BaseContainer):
     
     implements(IUserContainer)
     
+    def __setitem__(self, key, value):
+        # the groups of a replaced user may have changed
+        groups_cache.delete_on_commit(key)
+        return super(UserContainer, self).__setitem__(key, value)
+    
+    def __delitem__(self, key):
+        groups_cache.delete_on_commit(key)
+        return super(UserContainer, self).__delitem__(key)
+    
     def add_user(self, id, *args, **kwargs):
         if id in self.data:
             raise KeyError('There is already a user with the id `%s`' % id)
         user = User(id, *args, **kwargs)
-        user.groups.append('contributor')
-        self.data[id] = user
+        user.set_groups(['contributor'])
+        self[id] = user
     
 
 
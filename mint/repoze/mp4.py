@@ -0,0 +1,286 @@
+""" Reading MP4/QuickTime files without reading their media data
+
+    MP4 files are a sequence of boxes (atoms), each starting with a 32 bit
+    size and a four character type. Only the headers of the top level boxes
+    and the contents of the small `moov` box are read; `mdat`, which holds
+    the media itself, is skipped over by seeking.
+    
+    `faststart` moves a trailing `moov` box in front of the media so that
+    players can start before they have downloaded the whole file.
+"""
+from os import rename, unlink, fsync, fdopen
+from os.path import getsize, dirname
+from tempfile import mkstemp
+from StringIO import StringIO
+import struct
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from mint.repoze.ingest import BUFFER_SIZE
+
+class MP4Error(ValueError):
+    pass
+
+# boxes inside `moov` which contain other boxes
+container_boxes = frozenset(['moov', 'trak', 'mdia', 'minf', 'stbl', 'edts', 'dinf', 'udta'])
+
+mimetypes = {
+    'qt  ': u'video/quicktime',
+    'M4V ': u'video/x-m4v',
+    'M4VH': u'video/x-m4v',
+    'M4VP': u'video/x-m4v',
+}
+
+def box(kind, payload=''):
+    """ Returns a box of type `kind` holding `payload`. Only used for building
+        test files.
+        
+        >>> box('free', 'abcd')
+        '\\x00\\x00\\x00\\x0cfreeabcd'
+    """
+    return struct.pack('>I4s', len(payload) + 8, kind) + payload
+
+def iter_boxes(f, start, end):
+    """ Yields (type, offset, header size, box size) for each box in the file
+        `f` between `start` and `end`, seeking past their contents
+        
+        >>> from StringIO import StringIO
+        >>> data = box('ftyp', 'isom') + box('mdat', 'x' * 100) + box('moov')
+        >>> list(iter_boxes(StringIO(data), 0, len(data)))
+        [('ftyp', 0, 8, 12), ('mdat', 12, 8, 108), ('moov', 120, 8, 8)]
+    """
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        size, kind = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise MP4Error('bad size for `%s` box at %s' % (kind, offset))
+        yield kind, offset, header_size, size
+        offset += size
+
+def find_box(f, start, end, kind):
+    """ Returns the (offset, header size, box size) of the first `kind` box
+        between `start` and `end`, or None
+    """
+    for found, offset, header_size, size in iter_boxes(f, start, end):
+        if found == kind:
+            return offset, header_size, size
+    return None
+
+def parse_mvhd(data):
+    """ Returns the duration in seconds from the payload of an `mvhd` box
+        
+        >>> parse_mvhd(struct.pack('>4xIIII', 0, 0, 600, 1500))
+        2.5
+        >>> parse_mvhd('')
+        Traceback (most recent call last):
+        ...
+        MP4Error: `mvhd` box is too short
+    """
+    if data and ord(data[0]) == 1:
+        needed, fields = 32, ('>IQ', 20)
+    else:
+        needed, fields = 20, ('>II', 12)
+    if len(data) < needed:
+        raise MP4Error('`mvhd` box is too short')
+    fmt, offset = fields
+    timescale, duration = struct.unpack(fmt, data[offset:needed])
+    if not timescale:
+        return 0
+    return float(duration) / timescale
+
+def parse_tkhd(data):
+    """ Returns the (width, height) in pixels from the payload of a `tkhd` box
+        
+        >>> parse_tkhd('')
+        Traceback (most recent call last):
+        ...
+        MP4Error: `tkhd` box is too short
+    """
+    if data and ord(data[0]) == 1:
+        offset = 4 + 8 + 8 + 4 + 4 + 8
+    else:
+        offset = 4 + 4 + 4 + 4 + 4 + 4
+    # reserved, layer, alternate group, volume, reserved and the matrix
+    offset += 8 + 2 + 2 + 2 + 2 + 36
+    if len(data) < offset + 8:
+        raise MP4Error('`tkhd` box is too short')
+    width, height = struct.unpack('>II', data[offset:offset + 8])
+    return width >> 16, height >> 16
+
+def parse_moov(f, start, end, info):
+    for kind, offset, header_size, size in iter_boxes(f, start, end):
+        if kind in container_boxes:
+            parse_moov(f, offset + header_size, offset + size, info)
+        elif kind == 'mvhd':
+            f.seek(offset + header_size)
+            info['length'] = parse_mvhd(f.read(size - header_size))
+        elif kind == 'tkhd':
+            f.seek(offset + header_size)
+            width, height = parse_tkhd(f.read(size - header_size))
+            if width and height and not info.get('width'):
+                info['width'], info['height'] = width, height
+
+def probe_file(f, size):
+    """ Returns a dict of `length` (seconds), `size`, `mimetype`, `bitrate`
+        (bits per second), `width` and `height` for the MP4 file `f`.
+        Keys which couldn't be found are left out.
+        
+        >>> from StringIO import StringIO
+        >>> mvhd = box('mvhd', struct.pack('>IIIII', 0, 0, 0, 600, 45000) + '\\x00' * 80)
+        >>> tkhd = box('tkhd', struct.pack('>IIIIII', 0, 0, 0, 1, 0, 45000) + '\\x00' * 52 + struct.pack('>II', 640 << 16, 360 << 16))
+        >>> data = box('ftyp', 'M4V ') + box('mdat', 'x' * 1000) + box('moov', mvhd + box('trak', tkhd))
+        >>> info = probe_file(StringIO(data), len(data))
+        >>> sorted(info.items())
+        [('bitrate', 131), ('height', 360), ('length', 75.0), ('mimetype', u'video/x-m4v'), ('size', 1236), ('width', 640)]
+    """
+    info = {'size': size}
+    ftyp = find_box(f, 0, size, 'ftyp')
+    if ftyp is not None:
+        f.seek(ftyp[0] + ftyp[1])
+        info['mimetype'] = mimetypes.get(f.read(4), u'video/mp4')
+    moov = find_box(f, 0, size, 'moov')
+    if moov is None:
+        return info
+    offset, header_size, moov_size = moov
+    parse_moov(f, offset + header_size, offset + moov_size, info)
+    if info.get('length'):
+        info['bitrate'] = int(size * 8 / info['length'])
+    return info
+
+def probe(path):
+    """ Returns the metadata found in the MP4 file at `path`, see `probe_file` """
+    f = open(path, 'rb')
+    try:
+        return probe_file(f, getsize(path))
+    finally:
+        f.close()
+
+def patch_chunk_offsets(data, delta, start=0, end=None):
+    """ Returns the boxes in `data` with every chunk offset in their `stco`
+        and `co64` boxes moved along by `delta` bytes
+        
+        >>> stco = box('stco', struct.pack('>IIII', 0, 2, 16, 1016))
+        >>> moov = box('moov', box('trak', box('mdia', box('minf', box('stbl', stco)))))
+        >>> patched = patch_chunk_offsets(moov, 100)
+        >>> len(patched) == len(moov), struct.unpack('>II', patched[-8:])
+        (True, (116, 1116))
+    """
+    if end is None:
+        end = len(data)
+    f = StringIO(data)
+    pieces = []
+    position = start
+    for kind, offset, header_size, size in iter_boxes(f, start, end):
+        body = offset + header_size
+        if kind in container_boxes:
+            pieces.append(data[offset:body])
+            pieces.append(patch_chunk_offsets(data, delta, body, offset + size))
+        elif kind in ('stco', 'co64'):
+            if kind == 'stco':
+                format, limit = 'I', 0xFFFFFFFF
+            else:
+                format, limit = 'Q', 0xFFFFFFFFFFFFFFFF
+            count = struct.unpack('>I', data[body + 4:body + 8])[0]
+            table_end = body + 8 + count * struct.calcsize('>' + format)
+            if table_end > offset + size:
+                raise MP4Error('`%s` box at %s is truncated' % (kind, offset))
+            offsets = [chunk + delta for chunk in struct.unpack('>%d%s' % (count, format), data[body + 8:table_end])]
+            if offsets and max(offsets) > limit:
+                raise MP4Error('chunk offsets no longer fit in `%s`' % kind)
+            pieces.append(data[offset:body + 8])
+            pieces.append(struct.pack('>%d%s' % (count, format), *offsets))
+            pieces.append(data[table_end:offset + size])
+        else:
+            pieces.append(data[offset:offset + size])
+        position = offset + size
+    pieces.append(data[position:end])
+    return ''.join(pieces)
+
+def copy_range(src, dst, start, length, digest, buffer_size=BUFFER_SIZE):
+    src.seek(start)
+    while length > 0:
+        chunk = src.read(min(buffer_size, length))
+        if not chunk:
+            raise MP4Error('unexpected end of file')
+        digest.update(chunk)
+        dst.write(chunk)
+        length -= len(chunk)
+
+def faststart(path, buffer_size=BUFFER_SIZE):
+    """ Moves a `moov` box which follows the media data in the file at `path`
+        to before it, patching the chunk offsets to suit. Only the `moov` box
+        is held in memory; the rest is streamed into a temporary file which
+        replaces the original.
+        
+        Returns a tuple of whether the file now starts playback without
+        reading to the end, and the new md5 if it was rewritten (None if
+        the file was left alone).
+        
+        >>> from tempfile import mkdtemp
+        >>> from os.path import join
+        >>> stco = box('stco', struct.pack('>III', 0, 1, 20))
+        >>> moov = box('moov', box('trak', box('mdia', box('minf', box('stbl', stco)))))
+        >>> path = join(mkdtemp(), 'video.mp4')
+        >>> open(path, 'wb').write(box('ftyp', 'isom') + box('mdat', 'media') + moov)
+        >>> faststarted, digest = faststart(path)
+        >>> faststarted, digest == md5(open(path, 'rb').read()).hexdigest()
+        (True, True)
+        >>> [kind for kind, offset, header, size in iter_boxes(open(path, 'rb'), 0, getsize(path))]
+        ['ftyp', 'moov', 'mdat']
+        >>> data = open(path, 'rb').read()
+        >>> offset = struct.unpack('>I', data[len(moov) + 12 - 4:len(moov) + 12])[0]
+        >>> data[offset:offset + 5]
+        'media'
+        >>> faststart(path)
+        (True, None)
+    """
+    size = getsize(path)
+    f = open(path, 'rb')
+    try:
+        boxes = list(iter_boxes(f, 0, size))
+        kinds = [kind for kind, offset, header_size, box_size in boxes]
+        if 'moov' not in kinds or 'mdat' not in kinds:
+            return False, None
+        moov_index, mdat_index = kinds.index('moov'), kinds.index('mdat')
+        if moov_index < mdat_index:
+            return True, None
+        if 'mdat' in kinds[moov_index:]:
+            # media both before and after the moov isn't worth handling
+            return False, None
+        kind, moov_offset, header_size, moov_size = boxes[moov_index]
+        f.seek(moov_offset)
+        moov = patch_chunk_offsets(f.read(moov_size), moov_size)
+        mdat_offset = boxes[mdat_index][1]
+        
+        fd, tmp = mkstemp(suffix='.tmp', dir=dirname(path))
+        out = fdopen(fd, 'wb')
+        digest = md5()
+        try:
+            copy_range(f, out, 0, mdat_offset, digest, buffer_size)
+            digest.update(moov)
+            out.write(moov)
+            copy_range(f, out, mdat_offset, moov_offset - mdat_offset, digest, buffer_size)
+            copy_range(f, out, moov_offset + moov_size, size - moov_offset - moov_size, digest, buffer_size)
+            out.flush()
+            fsync(out.fileno())
+            out.close()
+            rename(tmp, path)
+        except:
+            out.close()
+            unlink(tmp)
+            raise
+    finally:
+        f.close()
+    return True, digest.hexdigest()
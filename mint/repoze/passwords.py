@@ -0,0 +1,128 @@
+""" Salted, deliberately slow password hashes
+
+    Passwords are stored as `pbkdf2_sha256$<iterations>$<salt>$<hash>`.
+    Users created before hashing was introduced still have their password
+    in plain text; `check_password` accepts those, and `needs_upgrade`
+    tells the caller to store a proper hash once the password is known to
+    be right. The same goes for hashes made with fewer iterations than the
+    `password_iterations` option asks for.
+"""
+from os import urandom
+from binascii import hexlify
+import hmac
+import struct
+try:
+    from hashlib import sha256, pbkdf2_hmac
+except ImportError:
+    from hashlib import sha256
+    pbkdf2_hmac = None
+
+ALGORITHM = 'pbkdf2_sha256'
+
+SALT_BYTES = 16
+
+iterations = 100000
+
+# keys credential digests, so they're useless outside this process
+_secret = urandom(32)
+
+def configure(options):
+    """ Sets the number of iterations new hashes use from the
+        `password_iterations` option
+    """
+    global iterations
+    iterations = int(options.get('password_iterations', iterations))
+
+def _pbkdf2(password, salt, rounds):
+    if pbkdf2_hmac is not None:
+        return pbkdf2_hmac('sha256', password, salt, rounds)
+    # python < 2.7.8: one block is all a sha256 sized key needs
+    mac = hmac.new(password, digestmod=sha256)
+    def prf(data):
+        h = mac.copy()
+        h.update(data)
+        return h.digest()
+    u = prf(salt + struct.pack('>I', 1))
+    result = [ord(c) for c in u]
+    for i in xrange(rounds - 1):
+        u = prf(u)
+        for j, c in enumerate(u):
+            result[j] ^= ord(c)
+    return ''.join([chr(c) for c in result])
+
+def _encode(password):
+    if isinstance(password, unicode):
+        return password.encode('utf-8')
+    return password
+
+def constant_time_equals(a, b):
+    """ Compares two strings in time depending only on their length
+    
+        >>> constant_time_equals('abc', 'abc'), constant_time_equals('abc', 'abd')
+        (True, False)
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def hash_password(password, salt=None, rounds=None):
+    """ Returns a salted hash of `password` to store
+    
+        >>> hash_password(u'secret', salt='salt', rounds=1000)
+        'pbkdf2_sha256$1000$73616c74$a8df899f3c4f204d967e0ad63c092987c10055ebb017b3d9d28add218d4f7aad'
+    """
+    if salt is None:
+        salt = urandom(SALT_BYTES)
+    if rounds is None:
+        rounds = iterations
+    digest = _pbkdf2(_encode(password), salt, rounds)
+    return '%s$%d$%s$%s' % (ALGORITHM, rounds, hexlify(salt), hexlify(digest))
+
+def _split(stored):
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        return None
+    return parts
+
+def check_password(password, stored):
+    """ Whether `password` matches the `stored` hash (or, for users who
+        haven't logged in since hashing was introduced, plain text)
+        
+        >>> stored = hash_password(u'secret', rounds=1000)
+        >>> check_password(u'secret', stored), check_password(u'guess', stored)
+        (True, False)
+        >>> check_password(u'secret', u'secret')
+        True
+    """
+    if not stored:
+        return False
+    parts = _split(stored)
+    if parts is None:
+        return constant_time_equals(_encode(password), _encode(stored))
+    rounds, salt, digest = int(parts[1]), parts[2].decode('hex'), parts[3]
+    return constant_time_equals(hexlify(_pbkdf2(_encode(password), salt, rounds)), digest)
+
+def needs_upgrade(stored):
+    """ Whether `stored` is plain text or weaker than new hashes would be
+    
+        >>> needs_upgrade(u'secret'), needs_upgrade(hash_password(u'secret', rounds=1))
+        (True, True)
+        >>> needs_upgrade(hash_password(u'secret'))
+        False
+    """
+    parts = _split(stored or '')
+    return parts is None or int(parts[1]) < iterations
+
+def credential_digest(login, password):
+    """ Identifies a login and password without keeping either, for
+        remembering credentials which have already been checked
+        
+        >>> credential_digest(u'admin', u'test') == credential_digest(u'admin', u'test')
+        True
+        >>> credential_digest(u'admin', u'test') == credential_digest(u'admin', u'tset')
+        False
+    """
+    return hmac.new(_secret, '%s\0%s' % (_encode(login), _encode(password)), sha256).hexdigest()
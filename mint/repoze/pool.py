@@ -0,0 +1,234 @@
+""" A bounded pool of ZODB connections, one per request
+
+    `ConnectionMiddleware` gives every request a `RequestConnection` in
+    `environ['mint.connection']`. The connection is only taken from the
+    pool when the request first asks for it, and is put back when the
+    server closes the response's iterable rather than when the environ
+    happens to be garbage collected. At most `pool_size` connections are
+    open at once; further requests wait up to `pool_timeout` seconds for
+    one to be returned before getting a `503 Service Unavailable`.
+"""
+from threading import Condition
+from time import time
+import logging
+
+log = logging.getLogger('mint.repoze.pool')
+
+ENVIRON_KEY = 'mint.connection'
+
+class PoolTimeout(Exception):
+    """ No connection was returned to the pool within `pool_timeout` """
+
+class ConnectionPool(object):
+    """ Hands out connections to the database returned by `get_db`, at most
+        `pool_size` at a time. `cache_size` (the number of objects each
+        connection keeps in memory) is set on the database when it is first
+        used.
+        
+        >>> class DummyConnection(object):
+        ...     def close(self):
+        ...         pass
+        >>> class DummyDB(object):
+        ...     def open(self):
+        ...         return DummyConnection()
+        ...     def setPoolSize(self, size):
+        ...         pass
+        ...     def setCacheSize(self, size):
+        ...         pass
+        >>> pool = ConnectionPool(DummyDB, pool_size=1, pool_timeout=0.01)
+        >>> conn = pool.open()
+        >>> pool.stats()['open']
+        1
+        >>> pool.open()
+        Traceback (most recent call last):
+            ...
+        PoolTimeout: no connection available after 0.01s
+        >>> pool.close(conn)
+        >>> pool.close(pool.open())
+        >>> stats = pool.stats()
+        >>> stats['open'], stats['opened'], stats['waits'], stats['timeouts']
+        (0, 2, 1, 1)
+    """
+    
+    def __init__(self, get_db, pool_size=7, pool_timeout=30, cache_size=None):
+        self.get_db = get_db
+        self.pool_size = int(pool_size)
+        self.pool_timeout = float(pool_timeout)
+        self.cache_size = cache_size and int(cache_size) or None
+        self.db = None
+        self.in_use = 0
+        self.opened = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._available = Condition()
+    
+    def _db(self):
+        if self.db is None:
+            db = self.get_db()
+            db.setPoolSize(self.pool_size)
+            if self.cache_size:
+                db.setCacheSize(self.cache_size)
+            self.db = db
+        return self.db
+    
+    def open(self):
+        """ Returns a connection, waiting for one to be closed if `pool_size`
+            are already open. Raises PoolTimeout after `pool_timeout` seconds.
+        """
+        started = time()
+        self._available.acquire()
+        try:
+            if self.in_use >= self.pool_size:
+                self.waits += 1
+                deadline = started + self.pool_timeout
+                while self.in_use >= self.pool_size:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout('no connection available after %ss' % self.pool_timeout)
+                    self._available.wait(remaining)
+                waited = time() - started
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            self.in_use += 1
+            self.opened += 1
+        finally:
+            self._available.release()
+        try:
+            return self._db().open()
+        except:
+            self._release()
+            raise
+    
+    def close(self, conn):
+        """ Closes `conn`, returning it to the pool """
+        try:
+            conn.close()
+        finally:
+            self._release()
+    
+    def _release(self):
+        self._available.acquire()
+        try:
+            self.in_use -= 1
+            self._available.notify()
+        finally:
+            self._available.release()
+    
+    def stats(self):
+        return {
+            'pool_size': self.pool_size,
+            'open': self.in_use,
+            'opened': self.opened,
+            'waits': self.waits,
+            'timeouts': self.timeouts,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+        }
+    
+
+class RequestConnection(object):
+    """ The connection for a single request, opened on first use
+    
+        >>> class DummyPool(object):
+        ...     def open(self):
+        ...         return 'conn'
+        ...     def close(self, conn):
+        ...         print 'closed', conn
+        >>> connection = RequestConnection(DummyPool())
+        >>> connection.close()
+        >>> connection.get(), connection.get()
+        ('conn', 'conn')
+        >>> connection.close()
+        closed conn
+        >>> connection.close()
+    """
+    
+    conn = None
+    
+    def __init__(self, pool):
+        self.pool = pool
+    
+    def get(self):
+        if self.conn is None:
+            self.conn = self.pool.open()
+        return self.conn
+    
+    def close(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool.close(conn)
+    
+
+class ClosingIterator(object):
+    """ Iterates over `app_iter`, calling `callback` once it is closed """
+    
+    def __init__(self, app_iter, callback):
+        self.app_iter = app_iter
+        self.callback = callback
+    
+    def __iter__(self):
+        return iter(self.app_iter)
+    
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.callback()
+    
+
+class ConnectionMiddleware(object):
+    """ WSGI middleware giving each request a connection from `pool`, which
+        is closed when the server closes the response
+        
+        >>> class DummyPool(object):
+        ...     def open(self):
+        ...         return 'conn'
+        ...     def close(self, conn):
+        ...         print 'closed', conn
+        >>> def app(environ, start_response):
+        ...     environ[ENVIRON_KEY].get()
+        ...     start_response('200 OK', [])
+        ...     return ['body']
+        >>> def start_response(status, headers):
+        ...     print status
+        >>> app_iter = ConnectionMiddleware(app, DummyPool())({}, start_response)
+        200 OK
+        >>> list(app_iter)
+        ['body']
+        >>> app_iter.close()
+        closed conn
+    """
+    
+    def __init__(self, app, pool):
+        self.app = app
+        self.pool = pool
+    
+    def __call__(self, environ, start_response):
+        connection = environ[ENVIRON_KEY] = RequestConnection(self.pool)
+        try:
+            app_iter = self.app(environ, start_response)
+        except PoolTimeout, e:
+            connection.close()
+            log.warning(str(e))
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain'), ('Retry-After', '1')])
+            return ['The server is busy, please try again shortly.']
+        except:
+            connection.close()
+            raise
+        return ClosingIterator(app_iter, connection.close)
+    
+
+def make_connection_pool(app, get_db, options):
+    """ Wraps `app` in a ConnectionMiddleware with a pool configured by the
+        `pool_size`, `pool_timeout` and `cache_size` options
+    """
+    pool = ConnectionPool(get_db,
+        pool_size=options.get('pool_size', 7),
+        pool_timeout=options.get('pool_timeout', 30),
+        cache_size=options.get('cache_size'),
+    )
+    return ConnectionMiddleware(app, pool)
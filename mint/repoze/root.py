@@ -1,5 +1,6 @@
 from zope.interface import implements
 from persistent.mapping import PersistentMapping
+from BTrees.Length import Length
 from repoze.bfg.interfaces import ILocation
 from repoze.bfg.security import Everyone, Allow, Deny, Authenticated
 
@@ -7,7 +8,7 @@ import logging
 
 log = logging.getLogger('mint.repoze.root')
 
-from repoze.bfg.traversal import find_root, find_model
+from repoze.bfg.traversal import find_root
 from mint.repoze.interfaces import IUtilityFinder
 
 from mint.repoze.test.data import video_container, users
@@ -15,16 +16,60 @@ from mint.repoze.models import UserContainer, User
 from mint.repoze.models import VideoContainer
 from mint.repoze.models import ChannelContainer
 from mint.repoze.models import AdSpaceContainer
+from mint.repoze.search import SearchIndex
+
+def find_jar(context):
+    """ Returns the connection `context` (or its nearest stored parent) was
+        loaded through, or None
+    """
+    while context is not None:
+        jar = getattr(context, '_p_jar', None)
+        if jar is not None:
+            return jar
+        context = getattr(context, '__parent__', None)
+    return None
+
+def find_path(root, path):
+    """ Returns the object at `path` below `root`. Unlike bfg's find_model
+        this doesn't need the traverser registered for the request, so
+        utilities can also be found from scripts and commit hooks.
+        
+        >>> find_path({'videos': {'intro': 'video'}}, ('videos', 'intro'))
+        'video'
+    """
+    for name in path:
+        root = root[name]
+    return root
 
 class PersistentUtilityFinder(object):
+    """ Finds utilities by their registered path from the root. Utilities
+        found through a connection are remembered until that connection's
+        transaction ends, so repeated lookups while handling a request
+        don't traverse the tree again.
+    """
     implements(IUtilityFinder)
     
     _utilities = {}
+    # connection -> (transaction, {utility name: utility})
+    _resolved = {}
     
     def __call__(self, context, utility_name):
         if utility_name not in self._utilities:
             raise KeyError('`%s` is not a registered utility' % utility_name)
-        return find_model(find_root(context), self._utilities[utility_name])
+        jar = find_jar(context)
+        if jar is None:
+            return find_path(find_root(context), self._utilities[utility_name])
+        txn = jar.transaction_manager.get()
+        resolved = self._resolved.get(jar)
+        if resolved is None or resolved[0] is not txn:
+            if resolved is None:
+                jar.onCloseCallback(lambda: self._resolved.pop(jar, None))
+            resolved = self._resolved[jar] = (txn, {})
+        utilities = resolved[1]
+        utility = utilities.get(utility_name)
+        if utility is None:
+            utility = utilities[utility_name] = find_path(find_root(context), self._utilities[utility_name])
+        return utility
     
     def register_utility(self, name, path):
         """ A utility object to store and retrieve paths to persistent utilities
@@ -72,6 +117,36 @@ class Root(PersistentMapping):
         self.data[key] = value
     
 
+def evolve_root(mint_root):
+    """ Brings a stored root up to date with the current models. Returns
+        True if anything was changed and needs committing
+    """
+    changed = False
+    for name in ('videos', 'channels', 'banners', 'users'):
+        if mint_root[name].migrate_data():
+            log.info('moved the contents of `%s` into a BTree' % name)
+            changed = True
+    videos = mint_root['videos']
+    if getattr(videos, 'date_index', None) is None:
+        log.info('building the tag and date indexes for `videos`')
+        videos.reindex()
+        changed = True
+    if getattr(videos, 'changes', None) is None:
+        videos.changes = Length()
+        changed = True
+    channels = mint_root['channels']
+    if getattr(channels, 'stings', None) is None:
+        log.info('building the sting map for `channels`')
+        channels.rebuild_stings()
+        changed = True
+    if getattr(videos, 'search_index', None) is None or len(videos.search_index) != len(videos):
+        log.info('building the search index for `videos`')
+        videos.search_index = SearchIndex()
+        for video in videos.values():
+            videos.search_index.index_video(video)
+        changed = True
+    return changed
+
 def init_zodb_root(zodb_root, base):
     if not base in zodb_root:
         log.debug('initialising real root in db')
@@ -88,6 +163,9 @@ def init_zodb_root(zodb_root, base):
         zodb_root[base] = mint_root
         import transaction
         transaction.commit()
+    if evolve_root(zodb_root[base]):
+        import transaction
+        transaction.commit()
     utility_finder.register_utility('videos', ('videos',))
     utility_finder.register_utility('channels', ('channels',))
     utility_finder.register_utility('banners', ('banners',))
@@ -111,6 +189,9 @@ def init_test_root(zodb_root, base):
         zodb_root[base] = mint_root
         import transaction
         transaction.commit()
+    if evolve_root(zodb_root[base]):
+        import transaction
+        transaction.commit()
     utility_finder.register_utility('videos', ('videos',))
     utility_finder.register_utility('channels', ('channels',))
     utility_finder.register_utility('banners', ('banners',))
@@ -142,8 +223,36 @@ class ZODBInit:
         return reset_root(zodb_root, self.base)
     
 
+class StoredRoot:
+    """ Returns the mint root stored under `base`, once `bootstrap` has
+        created it
+    """
+    def __init__(self, base):
+        self.base = base
+    
+    def __call__(self, zodb_root):
+        return zodb_root[self.base]
+    
+
+def bootstrap(db, base):
+    """ Creates (or brings up to date) the mint root stored under `base` in
+        `db` and registers its utilities. This only needs to happen once, at
+        startup, after which requests can go straight to `StoredRoot`.
+    """
+    import transaction
+    conn = db.open()
+    try:
+        try:
+            ZODBInit(base)(conn.root())
+        except:
+            transaction.abort()
+            raise
+    finally:
+        conn.close()
+
 
 from repoze.zodbconn.finder import dbfactory_from_uri#, Cleanup
+from mint.repoze.pool import ENVIRON_KEY as CONNECTION_KEY
 
 class Cleanup:
     def __init__(self, cleaner):
@@ -159,15 +268,22 @@ class PersistentApplicationFinder:
         self.appmaker = appmaker
         self.kw = kw
     
-    def __call__(self, environ):
+    def get_db(self):
         if self.db is None:
             dbfactory = dbfactory_from_uri(self.uri)
             self.db = dbfactory()
-        conn = self.db.open()
-        root = conn.root()
-        app = self.appmaker(root, **self.kw)
-        environ['repoze.zodbconn.closer'] = Cleanup(conn.close)
-        return app
+        return self.db
+    
+    def __call__(self, environ):
+        connection = environ.get(CONNECTION_KEY)
+        if connection is not None:
+            # closed by the ConnectionMiddleware once the response is sent
+            root = connection.get().root()
+        else:
+            conn = self.get_db().open()
+            root = conn.root()
+            environ['repoze.zodbconn.closer'] = Cleanup(conn.close)
+        return self.appmaker(root, **self.kw)
     
 
 
@@ -6,11 +6,18 @@ from zope.component import getUtility, getGlobalSiteManager
 
 import mint.repoze
 from mint.repoze.auth import middleware as auth_middleware
+from mint.repoze.cache import make_page_cache, configure_widget_cache
+from mint.repoze.feeds import make_feed_snapshots
+from mint.repoze.pool import make_connection_pool
+from mint.repoze import passwords
 from mint.repoze.interfaces import IVideoContainer
 from mint.repoze.models import Video
+from mint.repoze.views import configure_templates, startup_stats
 
 from os import makedirs
 from os.path import exists, abspath, dirname
+from threading import Lock
+from time import time
 import logging
 
 logging.basicConfig()
@@ -44,7 +51,13 @@ class MintApp:
         for option in required_config:
             if option not in self.options.keys(): raise LookupError('Missing required config item: %s' % option)
         mint.repoze.CONFIG.update(self.options)
+        configure_widget_cache(self.options)
+        configure_templates(self.options)
+        passwords.configure(self.options)
         self.get_root = self._get_root()
+        self.first_request = True
+        self.bootstrapped = False
+        self._bootstrap_lock = Lock()
     
     def _get_root(self):
         from mint.repoze.root import PersistentApplicationFinder
@@ -60,13 +73,27 @@ class MintApp:
                 pass
         global zodb_base
         zodb_base = self.options['zodb_base']
-        from mint.repoze.root import ZODBInit
-        init = ZODBInit(zodb_base)
-        get_root = PersistentApplicationFinder(zodb_uri, init)
+        from mint.repoze.root import StoredRoot
+        get_root = PersistentApplicationFinder(zodb_uri, StoredRoot(zodb_base))
 #         root = RoutesMapper(get_root)
 #         root = self.connect_routes(root)
         return get_root
     
+    def bootstrap(self):
+        """ Creates or evolves the stored root, once, before the first
+            request is handled
+        """
+        from mint.repoze.root import bootstrap
+        self._bootstrap_lock.acquire()
+        try:
+            if not self.bootstrapped:
+                started = time()
+                bootstrap(self.get_root.get_db(), self.options['zodb_base'])
+                startup_stats['bootstrap_seconds'] = time() - started
+                self.bootstrapped = True
+        finally:
+            self._bootstrap_lock.release()
+    
     def connect_routes(self, root):
         # root.connect('/contact.html', controller='contact.html')
         return root
@@ -75,12 +102,26 @@ class MintApp:
     def app(self):
 #         app = make_app(self.get_root, mint.repoze, authentication_policy=RepozeWho1AuthenticationPolicy(), options=self.options)
         app = make_app(self.get_root, mint.repoze, options=self.options)
-        app = auth_middleware(app, self.options['zodb_base'])
+        app = make_page_cache(app, self.get_root.get_db, self.options)
+        app = auth_middleware(app, self.options['zodb_base'], self.get_root.get_db,
+            self.options.get('groups_cache_ttl', 60), self.options.get('credentials_cache_ttl', 300))
+        app = make_connection_pool(app, self.get_root.get_db, self.options)
+        app = make_feed_snapshots(app, self.options)
         self.app = app
         return self.app
     
     def __call__(self, environ, start_response):
         environ['mint'] = self.options
+        if not self.bootstrapped:
+            self.bootstrap()
+        if self.first_request:
+            self.first_request = False
+            started = time()
+            try:
+                return self.app(environ, start_response)
+            finally:
+                startup_stats['first_request_seconds'] = time() - started
+                log.info('first request (%s) took %.3fs' % (environ.get('PATH_INFO'), startup_stats['first_request_seconds']))
         return self.app(environ, start_response)
     
     def __repr__(self):
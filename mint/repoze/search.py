@@ -0,0 +1,173 @@
+import re
+from math import log
+
+from zope.interface import implements
+from persistent import Persistent
+from BTrees.OOBTree import OOBTree
+from BTrees.OIBTree import OIBTree
+from BTrees.Length import Length
+import transaction
+
+from mint.repoze.interfaces import ISearchIndex
+
+word_re = re.compile(r'\w+', re.UNICODE)
+
+stop_words = frozenset([
+    u'a', u'an', u'and', u'are', u'as', u'at', u'be', u'by', u'for', u'from',
+    u'in', u'is', u'it', u'of', u'on', u'or', u'that', u'the', u'this', u'to',
+    u'was', u'with',
+])
+
+# how much a word counts for depending on where it was found
+field_weights = {
+    'name': 3,
+    'tags': 2,
+    'description': 1,
+}
+
+def tokenise(text):
+    """ Splits `text` into lowercase words, dropping stop words
+    
+        >>> tokenise(u'The Oil on Ice, oil!')
+        [u'oil', u'ice', u'oil']
+        >>> tokenise(None)
+        []
+    """
+    if not text:
+        return []
+    return [word for word in word_re.findall(text.lower()) if word not in stop_words]
+
+class SearchIndex(Persistent):
+    """ An incremental inverted index over the name, description and tags of
+        videos. Each word maps to an OOBTree of uid -> weight, so indexing a
+        video only touches the buckets for its own words.
+        
+        >>> from mint.repoze.models import Video
+        >>> index = SearchIndex()
+        >>> index.index_video(Video(u'oil', u'Oil on Ice', u'Drilling in the arctic', [u'arctic', u'water']))
+        >>> index.index_video(Video(u'ice', u'Melting', u'Arctic ice melting', [u'climate']))
+        >>> [uid for uid, score in index.search(u'arctic')]
+        [u'oil', u'ice']
+        >>> [uid for uid, score in index.search(u'Melting ARCTIC')]
+        [u'ice']
+        >>> index.search(u'nothing here')
+        []
+        >>> index.unindex(u'oil')
+        >>> [uid for uid, score in index.search(u'arctic')]
+        [u'ice']
+    
+    """
+    implements(ISearchIndex)
+    
+    def __init__(self):
+        self.postings = OOBTree()
+        self.frequencies = OIBTree()
+        self.documents = OOBTree()
+        self.count = Length()
+    
+    def __len__(self):
+        return self.count()
+    
+    def index_video(self, video):
+        """ Adds (or refreshes) the entries for `video` """
+        weights = {}
+        for field, text in [('name', video.name), ('description', video.description), ('tags', u' '.join(video.tags))]:
+            for word in tokenise(text):
+                weights[word] = weights.get(word, 0) + field_weights[field]
+        self.index(video.__name__, weights)
+    
+    def index(self, uid, weights):
+        """ Stores the mapping of word -> weight `weights` against `uid` """
+        self.unindex(uid)
+        for word, weight in weights.items():
+            uids = self.postings.get(word)
+            if uids is None:
+                uids = self.postings[word] = OOBTree()
+            uids[uid] = weight
+            self.frequencies[word] = self.frequencies.get(word, 0) + 1
+        self.documents[uid] = tuple(weights.keys())
+        self.count.change(1)
+    
+    def unindex(self, uid):
+        """ Removes any entries stored against `uid` """
+        words = self.documents.get(uid)
+        if words is None:
+            return
+        for word in words:
+            uids = self.postings.get(word)
+            if uids is not None and uid in uids:
+                del uids[uid]
+                if not uids:
+                    del self.postings[word]
+            frequency = self.frequencies.get(word, 1) - 1
+            if frequency > 0:
+                self.frequencies[word] = frequency
+            elif word in self.frequencies:
+                del self.frequencies[word]
+        del self.documents[uid]
+        self.count.change(-1)
+    
+    def search(self, query):
+        """ Returns a list of (uid, score) pairs for the videos matching every
+            word in `query`, best match first. Matches are found by walking
+            the rarest word's postings and probing the others.
+        """
+        words = []
+        for word in tokenise(query):
+            if word not in words:
+                words.append(word)
+        if not words:
+            return []
+        postings = []
+        for word in words:
+            uids = self.postings.get(word)
+            if uids is None:
+                return []
+            frequency = self.frequencies.get(word, 1)
+            postings.append((frequency, log(1.0 + float(len(self)) / frequency), uids))
+        postings.sort(key=lambda posting: posting[0])
+        rarest, others = postings[0], postings[1:]
+        results = []
+        for uid, weight in rarest[2].items():
+            score = weight * rarest[1]
+            for frequency, idf, uids in others:
+                other = uids.get(uid)
+                if other is None:
+                    break
+                score += other * idf
+            else:
+                results.append((-score, uid))
+        results.sort()
+        return [(uid, -score) for score, uid in results]
+    
+    def queue(self, video):
+        """ Schedules `video` to be (re)indexed when the current transaction
+            commits, so repeated edits within a transaction are indexed once
+        """
+        self._pending()[video.__name__] = video
+    
+    def queue_removal(self, uid):
+        """ Schedules `uid` to be unindexed when the current transaction commits """
+        self._pending()[uid] = None
+    
+    def _pending(self):
+        txn = transaction.get()
+        pending = getattr(self, '_v_pending', None)
+        if pending is None or pending[0] is not txn:
+            pending = self._v_pending = (txn, {})
+            txn.addBeforeCommitHook(self.flush, (pending[1],))
+        return pending[1]
+    
+    def flush(self, pending):
+        """ Applies the queued changes in `pending` to the index. Videos
+            which are no longer in their container (for instance because a
+            savepoint was rolled back) are unindexed.
+        """
+        for uid, video in pending.items():
+            parent = getattr(video, '__parent__', None)
+            if video is None or (parent is not None and parent.get(uid) is not video):
+                self.unindex(uid)
+            else:
+                self.index_video(video)
+        pending.clear()
+
@@ -0,0 +1,123 @@
+""" Timings for code on hot paths, run with
+
+        python -m mint.repoze.test.bench [videos] [requests] [logins]
+    
+    These aren't tests: they print how long each way of doing something
+    takes so that changes can be compared.
+"""
+import sys
+from time import time
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from repoze.bfg import testing
+from repoze.bfg.view import render_view
+from repoze.bfg.traversal import find_root, find_model
+
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+
+from mint.repoze.models import Video
+from mint.repoze.root import ZODBInit, StoredRoot, bootstrap, utility_finder
+from mint.repoze.auth import ZODBPlugin
+from mint.repoze.cache import TTLCache
+from mint.repoze.test.data import users
+from mint.repoze.views import video_listing_widget, render_listing
+
+def best_of(func, repeat=5):
+    """ Returns the quickest of `repeat` runs of `func`, in seconds """
+    timings = []
+    for i in range(repeat):
+        start = time()
+        func()
+        timings.append(time() - start)
+    return min(timings)
+
+def report(name, seconds, count, unit='video'):
+    print '%-32s %8.2fms %8.1fus per %s' % (name, seconds * 1000, seconds * 1000000 / count, unit)
+
+def bench_listing(count):
+    """ Rendering a channel page's listing one widget view at a time, as
+        the channel view used to, against `render_listing`
+    """
+    static_dir = mkdtemp()
+    try:
+        videos = [Video(u'video%s' % i, u'Video %s' % i, u'', [u'bench'], static_dir=static_dir) for i in range(count)]
+        testing.registerView('video_listing_widget', view=video_listing_widget)
+        request = testing.DummyRequest()
+        def per_item():
+            return u''.join([render_view(video, request, 'video_listing_widget').decode('utf-8') for video in videos])
+        def batched():
+            return render_listing(videos, request)
+        report('render_view per video', best_of(per_item), count)
+        report('render_listing', best_of(batched), count)
+    finally:
+        testing.cleanUp()
+        rmtree(static_dir)
+
+def bench_root_lookup(count):
+    """ Finding the mint root through ZODBInit, as every request used to,
+        against StoredRoot once the root has been bootstrapped, and finding
+        a utility by traversal against `utility_finder`
+    """
+    db = DB(MappingStorage())
+    try:
+        bootstrap(db, 'bench_mint')
+        conn = db.open()
+        zodb_root = conn.root()
+        init, stored = ZODBInit('bench_mint'), StoredRoot('bench_mint')
+        def per_request_init():
+            for i in range(count):
+                init(zodb_root)
+        def stored_root():
+            for i in range(count):
+                stored(zodb_root)
+        report('ZODBInit per request', best_of(per_request_init), count, 'request')
+        report('StoredRoot per request', best_of(stored_root), count, 'request')
+        
+        channels = stored(zodb_root)['channels']
+        def traversed():
+            for i in range(count):
+                find_model(find_root(channels), ('videos',))
+        def cached():
+            for i in range(count):
+                utility_finder(channels, 'videos')
+        report('find_model per lookup', best_of(traversed), count, 'lookup')
+        report('utility_finder per lookup', best_of(cached), count, 'lookup')
+        conn.close()
+    finally:
+        db.close()
+
+def bench_basic_auth(count):
+    """ Authenticating a basic auth client on every request, hashing its
+        password each time against remembering checked credentials
+    """
+    db = DB(MappingStorage())
+    try:
+        bootstrap(db, 'bench_mint')
+        def find_users(root, base):
+            return root[base]['users']
+        admin = users['admin']
+        identity = {'login': admin['id'], 'password': admin['password']}
+        def authenticate(plugin):
+            def run():
+                for i in range(count):
+                    assert plugin.authenticate({}, identity) == admin['id']
+            return run
+        hashing = ZODBPlugin(lambda: db, find_users, 'bench_mint', verified=TTLCache(0))
+        remembering = ZODBPlugin(lambda: db, find_users, 'bench_mint', verified=TTLCache())
+        report('hashing every request', best_of(authenticate(hashing), 3), count, 'request')
+        report('remembered credentials', best_of(authenticate(remembering), 3), count, 'request')
+    finally:
+        db.close()
+
+def main(argv=sys.argv):
+    videos = len(argv) > 1 and int(argv[1]) or 500
+    requests = len(argv) > 2 and int(argv[2]) or 10000
+    logins = len(argv) > 3 and int(argv[3]) or 20
+    bench_listing(videos)
+    bench_root_lookup(requests)
+    bench_basic_auth(logins)
+
+if __name__ == '__main__':
+    main()
@@ -42,6 +42,23 @@ def login(user=users[u'admin'], url=u'/login.html', app=app):
     except KeyError:
         print res
 
+def edit_elsewhere(edit):
+    u"This is not a test!  It calls `edit` with the test root in a connection of its own, and commits"
+    from repoze.zodbconn.finder import dbfactory_from_uri
+    import transaction
+    db = dbfactory_from_uri('zeo://localhost:8100/')()
+    conn = db.open()
+    try:
+        edit(conn.root()['test_mint'])
+        transaction.commit()
+    finally:
+        transaction.abort()
+        conn.close()
+        db.close()
+    # give the application's ZEO client a moment to hear of the commit
+    import time
+    time.sleep(0.5)
+
 def login_as_admin():
     return login(user=users['admin'])
 
@@ -173,6 +190,45 @@ def test_oil_on_ice_video(res=None):
             "%s tag should be in body" % tag
         )
 
+def test_search_page():
+    """`/search.html` finds videos by name, description and tags"""
+    res = app.get('/search.html?q=oil')
+    assert_true(
+        'oil_on_ice-result' in res.body,
+        u'Oil on Ice should be found when searching for `oil`'
+    )
+    res = app.get('/search.html?q=greenpeace')
+    assert_true(
+        'toxic_sperm-result' in res.body,
+        u'videos should be searchable by tag'
+    )
+
+def test_search_escapes_query():
+    """`/search.html` doesn't echo markup from the query"""
+    res = app.get('/search.html', {'q': '"><script>alert(1)</script>'})
+    assert_false(
+        '<script>alert(1)</script>' in res.body,
+        u'the query should be escaped wherever it is shown'
+    )
+    assert_true('&lt;script&gt;' in res.body)
+
+def test_search_json():
+    """`/search.json` returns ranked results as JSON"""
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    res = app.get('/search.json?q=feature')
+    data = json.loads(res.body)
+    assert_true(
+        data['total'] >= 3,
+        u'all featured videos should match'
+    )
+    assert_true(
+        '/videos/intro' in [result['url'] for result in data['results']],
+        u'results should link to the video pages'
+    )
+
 def test_legacy_video_redirect():
     """/[video_name] redirects to /videos/[video_name]"""
     res = app.get('/intro')
@@ -209,6 +265,24 @@ def test_channel_page(res=None, channel=None):
         res = res.click('Intro')
         test_intro_video(res)
 
+def test_channel_page_pagination():
+    """channel pages accept a `?page=` parameter"""
+    res = app.get('/channels/feature?page=1')
+    assert_true(
+        'intro-listing' in res.body,
+        u'intro should be on the first page of the feature channel'
+    )
+    res = app.get('/channels/feature?page=99')
+    assert_true(
+        '200' in res.status and 'intro-listing' not in res.body,
+        u'pages past the end should be empty'
+    )
+    res = app.get('/channels/feature?page=foo')
+    assert_true(
+        'intro-listing' in res.body,
+        u'a bad page number should fall back to the first page'
+    )
+
 @with_setup(login,logout)
 def test_persistent_channel_page(res=None, channel=None):
     if res == None and channel == None:
@@ -246,6 +320,73 @@ def test_persistent_channel_page(res=None, channel=None):
             u'The new `%s` should be displayed on the channel page' % k
         )
 
+def test_channel_stings():
+    """A channel's stings are played around the videos tagged with it"""
+    login_as_admin()
+    app.post('/channels/arctic/edit.html', {
+        u'channel.title': u'Arctic',
+        u'channel.description': u'The arctic channel',
+        u'sting.pre_roll': u'intro',
+        u'sting.end_roll': u'',
+    })
+    res = app.get('/videos/oil_on_ice')
+    assert_true(
+        u"[u'intro', u'oil_on_ice']" in res.body,
+        u'The arctic pre roll should be played before the video'
+    )
+    app.post('/channels/arctic/edit.html', {
+        u'channel.title': u'Arctic',
+        u'channel.description': u'The arctic channel',
+        u'sting.pre_roll': u'',
+        u'sting.end_roll': u'',
+    })
+    res = app.get('/videos/oil_on_ice')
+    assert_false(
+        u"u'intro'" in res.body,
+        u'The pre roll should be gone once it is removed from the channel'
+    )
+    logout()
+
+def test_podcast_conditional_get():
+    """`podcast.xml` answers repeat polls with `304 Not Modified`"""
+    res = app.get('/videos/podcast.xml')
+    assert_true(
+        '<rss' in res.body,
+        u'the feed should be rendered'
+    )
+    etag = res.headers['ETag']
+    app.get('/videos/podcast.xml', headers={'If-None-Match': etag}, status=304)
+    app.get('/channels/feature/podcast.xml', headers={'If-None-Match': etag}, status=200)
+
+def test_podcast_enclosures():
+    """Podcast enclosures link to the encode their length and type describe"""
+    res = app.get('/videos/podcast.xml?page=1')
+    assert_true(
+        '/intro/intro.mp4"' in res.body and '.m4v"' not in res.body,
+        u'the enclosure should link to the mp4 encode its metadata comes from'
+    )
+    assert_true(
+        'type="video/mp4"' in res.body,
+        u'the enclosure type should be that of the linked encode'
+    )
+
+def test_podcast_etag_follows_older_videos():
+    """`podcast.xml` changes its ETag when a video other than the newest is edited"""
+    # a query string skips the snapshots written to `feed_dir`
+    res = app.get('/videos/podcast.xml?page=1')
+    etag = res.headers['ETag']
+    app.get('/videos/podcast.xml?page=1', headers={'If-None-Match': etag}, status=304)
+    def edit(mint_root):
+        videos = mint_root['videos']
+        videos['oil_on_ice'].description = u'Oil on the arctic ice'
+        videos.index_video(videos['oil_on_ice'])
+    edit_elsewhere(edit)
+    res = app.get('/videos/podcast.xml?page=1', headers={'If-None-Match': etag}, status=200)
+    assert_true(
+        res.headers['ETag'] != etag,
+        u'the feed should have a new ETag once an older video has changed'
+    )
+
 def test_reachable_static():
     """Static files are accessible at `/static/`"""
     res = app.get('/static/css/screen.css')
@@ -254,6 +395,22 @@ def test_reachable_static():
         u'`200` not in response'
     )
 
+def test_fingerprinted_static():
+    """Pages link to fingerprinted assets which may be cached forever"""
+    import re
+    res = app.get('/')
+    match = re.search(r'href="(/static/css/screen\.[0-9a-f]{12}\.css)"', res.body)
+    assert_true(
+        match is not None,
+        u'the stylesheet link should be fingerprinted'
+    )
+    res = app.get(match.group(1), headers={'Accept-Encoding': 'gzip'})
+    assert_true(
+        'immutable' in res.headers['Cache-Control'],
+        u'fingerprinted assets should never need revalidating'
+    )
+    assert_equals(res.headers.get('Content-Encoding'), 'gzip')
+
 def test_reachable_static_encodes():
     """Static files are accessible at `/encodes/`"""
     res = app.get('/encodes/intro/intro.mp4')
@@ -262,6 +419,26 @@ def test_reachable_static_encodes():
         u'`200` not in response'
     )
 
+def test_encodes_byte_ranges():
+    """Encodes can be fetched in parts and revalidated by ETag"""
+    full = app.get('/encodes/intro/intro.mp4')
+    res = app.get('/encodes/intro/intro.mp4', headers={'Range': 'bytes=0-99'}, status=206)
+    assert_equals(res.body, full.body[:100])
+    assert_equals(res.headers['Content-Range'], 'bytes 0-99/%s' % len(full.body))
+    res = app.get('/encodes/intro/intro.mp4', headers={'Range': 'bytes=0-9,-10'}, status=206)
+    assert_true(
+        res.headers['Content-Type'].startswith('multipart/byteranges'),
+        u'Several ranges should be sent as multipart/byteranges'
+    )
+    app.get('/encodes/intro/intro.mp4', headers={'If-None-Match': full.headers['ETag']}, status=304)
+    res = app.get('/encodes/intro/intro.mp4', headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'}, status=200)
+    assert_equals(len(res.body), len(full.body))
+    res = app.get('/encodes/intro/intro.mp4', headers={'Range': 'bytes=0-9', 'If-Range': 'W/' + full.headers['ETag']}, status=200)
+    assert_equals(len(res.body), len(full.body))
+    res = app.get('/encodes/intro/intro.mp4', headers={'Range': 'bytes=0-9,5-19'}, status=206)
+    assert_equals(res.headers['Content-Range'], 'bytes 0-19/%s' % len(full.body))
+    app.get('/encodes/intro/intro.mp4', headers={'Range': 'bytes=' + ','.join(['%d-%d' % (i, i) for i in range(0, 40, 2)])}, status=200)
+
 def test_widgets():
     from mint.repoze.views import ResponseTemplate, with_widgets
     
@@ -313,6 +490,80 @@ def test_widgets_with_context():
         u'test widget should have been rendered'
     )
 
+def test_widgets_single_render():
+    from mint.repoze.views import TemplateSpec, with_widgets
+    
+    def test_widget(context, request):
+        return Response('heres some test widget text')
+    
+    testing.registerView('test_widget', view=test_widget)
+    
+    @with_widgets('test_widget')
+    def test_widget_view(context, request):
+        return TemplateSpec('test/blank.html', context=context, request=request)
+    
+    @with_widgets('test_widget', stream=True)
+    def test_streamed_view(context, request):
+        return TemplateSpec('test/blank.html', context=context, request=request)
+    
+    context = testing.DummyModel()
+    request = testing.DummyRequest()
+    res = test_widget_view(context, request)
+    assert_equals(res.widgets['test_widget'], 'heres some test widget text')
+    streamed = test_streamed_view(context, request)
+    assert_equals(''.join(streamed.app_iter), res.body)
+
+def test_has_default_view():
+    """a listing widget registered for IVideo overrides the default one"""
+    from zope.interface import Interface, directlyProvides
+    from mint.repoze.interfaces import IVideo
+    from mint.repoze.views import has_default_view
+    
+    def default_widget(context, request):
+        return Response('the default listing')
+    
+    def video_widget(context, request):
+        return Response('a listing for videos')
+    
+    testing.registerView('test_listing_widget', view=default_widget)
+    testing.registerView('test_listing_widget', view=video_widget, for_=(IVideo, Interface))
+    
+    request = testing.DummyRequest()
+    video = testing.DummyModel()
+    directlyProvides(video, IVideo)
+    assert_true(has_default_view(testing.DummyModel(), request, 'test_listing_widget', default_widget))
+    assert_false(
+        has_default_view(video, request, 'test_listing_widget', default_widget),
+        u'the view registered for IVideo should not count as the default'
+    )
+
+def test_widgets_follow_edits():
+    """cached widgets re-render once their video is changed by another client"""
+    logout()
+    res = app.get('/videos/toxic_sperm')
+    assert_true(u'Toxic Sperm-tags' in res.body)
+    res = app.get('/')
+    description = u'A new description for the intro'
+    assert_false(description in res.body)
+    def rename(mint_root):
+        mint_root['videos']['toxic_sperm'].name = u'Toxic Sperm Whales'
+        mint_root['videos']['intro'].description = description
+    edit_elsewhere(rename)
+    res = app.get('/videos/toxic_sperm')
+    assert_true(
+        u'Toxic Sperm Whales-tags' in res.body,
+        u'the tags widget should have been rendered again for the renamed video'
+    )
+    res = app.get('/')
+    assert_true(
+        description in res.body,
+        u'the video widget should show the new description of the default video'
+    )
+    def restore(mint_root):
+        mint_root['videos']['toxic_sperm'].name = u'Toxic Sperm'
+        mint_root['videos']['intro'].description = u''
+    edit_elsewhere(restore)
+
 def test_user_exists(user=users[u'admin']):
     res = app.get('/users/%s/profile.html' % user['id'])
     assert_true(
@@ -320,6 +571,74 @@ def test_user_exists(user=users[u'admin']):
         u'User ID should be in the profile page'
     )
 
+@with_setup(login_as_contributor, logout)
+def test_groups_cache_invalidation():
+    """A user's cached groups are dropped when a commit changes them"""
+    from mint.repoze.cache import groups_cache
+    app.get('/')
+    assert_equals(groups_cache.get('contributor'), ('contributor',))
+    def set_groups_and_abort(mint_root):
+        mint_root['users']['contributor'].set_groups(['contributor', 'editor'])
+        raise ValueError('abort')
+    assert_raises(ValueError, edit_elsewhere, set_groups_and_abort)
+    assert_equals(
+        groups_cache.get('contributor'), ('contributor',),
+        u'an aborted change should leave the cached groups alone'
+    )
+    edit_elsewhere(lambda mint_root: mint_root['users']['contributor'].set_groups(['contributor', 'editor']))
+    assert_true(
+        groups_cache.get('contributor') is None,
+        u'the groups should be dropped once the change has committed'
+    )
+    app.get('/')
+    assert_equals(groups_cache.get('contributor'), ('contributor', 'editor'))
+    edit_elsewhere(lambda mint_root: mint_root['users']['contributor'].set_groups(['contributor']))
+
+def add_legacy_user(uid):
+    u"This is not a test!  It stores a user whose password is in plain text, as they were before hashing"
+    from mint.repoze.models import User
+    def add(mint_root):
+        user = User(uid, u'%s@mint.com' % uid, u'legacy')
+        user.password = u'legacy'
+        mint_root['users'][uid] = user
+    edit_elsewhere(add)
+    # byte strings, like `users`, as webtest can't encode unicode form values
+    return {'id': str(uid), 'email': '%s@mint.com' % uid, 'password': 'legacy'}
+
+def stored_password(uid):
+    u"This is not a test!  It returns the password stored for `uid`"
+    passwords = []
+    edit_elsewhere(lambda mint_root: passwords.append(mint_root['users'][uid].password))
+    return passwords[0]
+
+@with_setup(logout, logout)
+def test_legacy_password_upgrade():
+    """Users with a plain text password get a hash when they log in"""
+    user = add_legacy_user(u'legacy')
+    login(user)
+    assert_true(
+        stored_password(u'legacy').startswith('pbkdf2_sha256$'),
+        u'logging in through the site should store a hashed password'
+    )
+
+def test_legacy_password_upgrade_own_connection():
+    """ZODBPlugin upgrades plain text passwords outside a request's connection too"""
+    from repoze.zodbconn.finder import dbfactory_from_uri
+    from mint.repoze.auth import ZODBPlugin
+    from mint.repoze.cache import TTLCache
+    user = add_legacy_user(u'legacy2')
+    db = dbfactory_from_uri('zeo://localhost:8100/')()
+    try:
+        plugin = ZODBPlugin(lambda: db, lambda root, base: root[base]['users'], 'test_mint', verified=TTLCache())
+        identity = {'login': user['id'], 'password': user['password']}
+        assert_equals(plugin.authenticate({}, identity), user['id'])
+    finally:
+        db.close()
+    assert_true(
+        stored_password(u'legacy2').startswith('pbkdf2_sha256$'),
+        u'the plugin should commit the new hash on a connection of its own'
+    )
+
 @with_setup(logout)
 def test_register_new_user():
     new_user = {
@@ -406,6 +725,30 @@ def test_add_video():
     )
     
 
+@with_setup(login_as_contributor,logout)
+def test_upload_video():
+    """Uploaded encodes end up in the video directory, with nothing left spooled"""
+    from os import listdir
+    from os.path import isdir
+    data = 'not really a video ' * 100
+    res = app.post(
+        '/videos/add_video.html',
+        {
+            'video.name': 'uploadvid',
+            'video.description': 'An uploaded video for our tests',
+            'video.tags': 'upload'
+        },
+        upload_files=[('video.file', 'uploadvid.mp4', data)]
+    )
+    assert_true(
+        'successful' in res.body,
+        u'post not successful'
+    )
+    videos = join(dirname(__file__), 'var', 'videos')
+    assert_equals(open(join(videos, 'uploadvid', 'uploadvid.mp4'), 'rb').read(), data)
+    spool = join(videos, '.uploads')
+    assert_equals(isdir(spool) and listdir(spool) or [], [])
+
 @with_setup(login_as_admin,logout)
 def test_edit_video():
     """Publish a new video through the web interface"""
@@ -426,6 +769,75 @@ def test_edit_video():
     )
     
 
+def test_page_cache():
+    """Anonymous page views are served from the page cache until the next commit"""
+    logout()
+    app.get('/videos/testvid1')
+    res = app.get('/videos/testvid1')
+    assert_equals(res.headers.get('X-Cache'), 'HIT')
+    login_as_admin()
+    res = app.get('/videos/testvid1/edit.html')
+    form = res.form
+    form['video.description'] = u'freshly-edited-description'
+    form.submit()
+    logout()
+    res = app.get('/videos/testvid1')
+    assert_true(
+        u'freshly-edited-description' in res.body,
+        u'A commit should invalidate the cached page'
+    )
+
+def test_feed_snapshots():
+    """Editing a video writes its feeds to disk, where they are served from"""
+    from os.path import exists
+    login_as_admin()
+    res = app.get('/videos/testvid1/edit.html')
+    form = res.form
+    form['video.description'] = u'snapshot-description'
+    form.submit()
+    logout()
+    snapshot = join(dirname(__file__), 'var', 'feeds', 'videos', 'podcast.xml')
+    assert_true(
+        exists(snapshot) and exists(snapshot + '.gz'),
+        u'the videos feed and a gzipped copy should have been written'
+    )
+    assert_true(
+        exists(snapshot + '.serial'),
+        u'the serial of the transaction which wrote the feed should be beside it'
+    )
+    res = app.get('/videos/podcast.xml', headers={'Accept-Encoding': 'gzip'})
+    assert_equals(res.headers.get('Content-Encoding'), 'gzip')
+    res = app.get('/videos/podcast.xml', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert_equals(res.headers.get('Content-Encoding'), None)
+
+@with_setup(login_as_admin,logout)
+def test_cache_stats():
+    """`/stats.json` reports how often cached widgets are reused"""
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    app.get('/videos/intro')
+    app.get('/videos/intro')
+    res = app.get('/stats.json')
+    data = json.loads(res.body)
+    assert_true(
+        data['widgets']['widgets']['tags_widget']['hits'] >= 1,
+        u'the tags widget should be served from the widget cache'
+    )
+    assert_true(
+        'hit_rate' in data['pages'],
+        u'page cache stats should be reported too'
+    )
+    assert_true(
+        data['groups']['hits'] >= 1,
+        u'the admin user\'s groups should only have been loaded once'
+    )
+    assert_equals(
+        data['connections']['open'], 1,
+        u'only the stats request itself should be holding a connection'
+    )
+
 @with_setup(login_as_admin,logout)
 def test_set_default_video():
     res = app.get('/set_default_video.html')
@@ -507,6 +919,89 @@ def test_edit_adspace():
         u'The form post should return a success message'
     )
 
+from mint.repoze.models import VideoContainer
+
+class ImportTestContainer(VideoContainer):
+    u"This is not a test!  A VideoContainer which fails to store some videos after indexing them"
+    interrupted = True
+    
+    def __setitem__(self, key, value):
+        ret = super(ImportTestContainer, self).__setitem__(key, value)
+        if key == u'broken':
+            raise ValueError(u'could not store %s' % key)
+        if key == u'interrupted' and self.interrupted:
+            raise KeyboardInterrupt
+        return ret
+    
+
+def test_import_manifest():
+    """Imports commit in batches, roll back bad rows and resume from the progress file"""
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from os.path import exists
+    from ZODB import DB
+    from ZODB.MappingStorage import MappingStorage
+    from mint.repoze import CONFIG
+    from mint.repoze.importer import import_manifest
+    import transaction
+    tmp = mkdtemp()
+    master = join(tmp, 'master.mp4')
+    open(master, 'wb').write('not really a video')
+    manifest = join(tmp, 'manifest.csv')
+    rows = ['name,description,tags,encodes']
+    for name in ('first', 'broken', 'third', 'interrupted'):
+        rows.append('%s,The %s video,%s,mp4=%s' % (name, name, name, master))
+    open(manifest, 'wb').write('\n'.join(rows) + '\n')
+    progress = manifest + '.progress'
+    video_dir = join(tmp, 'videos')
+    old_video_dir = CONFIG.get('video_dir')
+    CONFIG['video_dir'] = video_dir
+    db = DB(MappingStorage())
+    conn = db.open()
+    try:
+        conn.root()['videos'] = ImportTestContainer()
+        transaction.commit()
+        videos = conn.root()['videos']
+        
+        assert_raises(KeyboardInterrupt, import_manifest, videos, manifest, batch_size=2, progress=progress)
+        assert_equals(open(progress).read(), '2\n', u'the first batch should have been recorded')
+        other = db.open()
+        try:
+            assert_equals(
+                sorted(other.root()['videos'].keys()), [u'first'],
+                u'the first batch should have been committed, the interrupted one aborted'
+            )
+        finally:
+            other.close()
+        assert_true(exists(join(video_dir, 'first', 'first.mp4')))
+        for name in (u'broken', u'third', u'interrupted'):
+            assert_false(
+                exists(join(video_dir, name)),
+                u'the encodes of %s should have been removed' % name
+            )
+            assert_false(
+                name in videos.tag_index or name in videos._sort_keys,
+                u'%s should have left no index entries' % name
+            )
+        assert_equals(len(videos.date_index), 1)
+        
+        videos.interrupted = False
+        imported, failed, seconds = import_manifest(videos, manifest, batch_size=2, progress=progress)
+        assert_equals((imported, failed), (2, 0), u'the second run should resume after row 2')
+        assert_equals(open(progress).read(), '4\n')
+        assert_equals(sorted(videos.keys()), [u'first', u'interrupted', u'third'])
+        assert_equals(len(videos.date_index), 3)
+        assert_false(exists(join(video_dir, 'broken')))
+    finally:
+        transaction.abort()
+        conn.close()
+        db.close()
+        if old_video_dir is None:
+            del CONFIG['video_dir']
+        else:
+            CONFIG['video_dir'] = old_video_dir
+        rmtree(tmp)
+
 def test_rules_the_world(world=True):
     """This app rules the world"""
     print u'well done you broke the mould'
@@ -1,14 +1,39 @@
 from webob import Response
+from webob.multidict import MultiDict, UnicodeMultiDict
 from webob.exc import HTTPNotFound, HTTPMovedPermanently, HTTPFound as redirect, HTTPUnauthorized
-from jinja2 import Environment, PackageLoader
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache, TemplateError
 from repoze.bfg.view import bfg_view, render_view
-from repoze.bfg.interfaces import IRequest, IRootFactory
+from repoze.bfg.traversal import find_root
+from repoze.bfg.interfaces import IRequest, IRootFactory, IView
 #from repoze.bfg.interfaces import IGETRequest, IPOSTRequest
-from zope.component import getUtility, getGlobalSiteManager
+from zope.component import getUtility, getGlobalSiteManager, getSiteManager
+from zope.interface import providedBy
+from persistent.TimeStamp import TimeStamp
+from ZODB.utils import z64
 import transaction
 import logging
-
+from urllib import quote
+from os import makedirs
+from os.path import isdir, join
+from time import time
+from email.utils import formatdate
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from mint.repoze import CONFIG
 from mint.repoze.root import Root, utility_finder
+from mint.repoze.cache import cacheable, cacheable_for_slot, serial, widget_cache, groups_cache, credentials_cache
+from mint.repoze.cache import vary_on_user, vary_on_context, vary_on_slot
+from mint.repoze.fileserver import not_modified
+from mint.repoze.ingest import spooling_field_storage
+from mint.repoze.feeds import feed_publisher
+from mint.repoze.assets import StaticURL, configure_assets
 from mint.repoze.models import Video, Channel
 from mint.repoze.interfaces import IVideo, IVideoContainer, IChannel, IChannelContainer, IUserContainer, IUser, IAdSpaceContainer, IAdSpace, IAdvert, ISyndication
 
@@ -16,17 +41,117 @@ log = logging.getLogger('mint.views')
 
 ## Utils
 
+def duration(seconds):
+    """ Formats a number of seconds as [H:]MM:SS
+        
+        >>> duration(75.4), duration(3725), duration(None)
+        ('01:15', '1:02:05', '00:00')
+    """
+    minutes, seconds = divmod(int(seconds or 0), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%02d:%02d' % (minutes, seconds)
+
+def urlencode(value):
+    """ Quotes `value` for a query string, for Jinja2 versions before 2.7
+        which don't have the filter
+        
+        >>> urlencode(u'oil & ice #1')
+        'oil%20%26%20ice%20%231'
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return quote(value, safe='')
+
 env = Environment(loader=PackageLoader('mint.repoze', 'templates'))
+env.filters['duration'] = duration
+env.filters.setdefault('urlencode', urlencode)
+env.globals['static_url'] = StaticURL()
+
+# timings from startup, reported through stats.json
+startup_stats = {}
+
+def as_bool(value):
+    """ Reads a boolean option from the app config
+        
+        >>> as_bool('true'), as_bool('On'), as_bool('false'), as_bool(None)
+        (True, True, False, False)
+    """
+    return str(value).strip().lower() in ('true', 'yes', 'on', '1')
+
+def configure_templates(options):
+    """ Stores compiled templates in the `template_cache_dir` directory, so
+        that they survive restarts and are shared between worker processes,
+        sets up `static_url` (see `mint.repoze.assets`) and compiles every
+        template up front if `warmup_templates` is set
+    """
+    cache_dir = options.get('template_cache_dir')
+    if cache_dir:
+        if not isdir(cache_dir):
+            makedirs(cache_dir)
+        env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    configure_assets(env, options)
+    if as_bool(options.get('warmup_templates', False)):
+        warmup_templates()
+
+def warmup_templates():
+    """ Loads (and so compiles) every template, returning how many were
+        loaded and how long it took
+    """
+    started = time()
+    count = 0
+    for name in env.list_templates():
+        try:
+            env.get_template(name)
+        except TemplateError:
+            log.exception('could not compile template `%s`' % name)
+        else:
+            count += 1
+    seconds = time() - started
+    startup_stats['templates_compiled'] = count
+    startup_stats['template_warmup_seconds'] = seconds
+    log.info('compiled %s templates in %.3fs' % (count, seconds))
+    return count, seconds
+
+def page_number(request):
+    """ Returns the page requested through `?page=`, defaulting to 1 """
+    try:
+        return max(int(request.params.get('page', 1)), 1)
+    except ValueError:
+        return 1
+
+def spooled_post(request, spool_dir):
+    """ Returns the request's form like `request.POST`, except that files
+        uploaded with it are spooled into `spool_dir` (see
+        `mint.repoze.ingest.spooling_field_storage`) to be linked into
+        place rather than copied
+    """
+    environ = request.environ
+    if not environ.get('CONTENT_TYPE', '').startswith('multipart/form-data'):
+        return request.POST
+    fs_environ = environ.copy()
+    fs_environ.setdefault('CONTENT_LENGTH', '0')
+    fs_environ['QUERY_STRING'] = ''
+    FieldStorage = spooling_field_storage(spool_dir)
+    form = MultiDict.from_fieldstorage(FieldStorage(fp=request.body_file, environ=fs_environ, keep_blank_values=True))
+    if request.charset:
+        form = UnicodeMultiDict(form, encoding=request.charset)
+    return form
 
 class ResponseTemplate(Response):
+    """ A Response holding a rendered Jinja2 template. Keyword arguments
+        which aren't Response attributes are passed to the template, along
+        with any `widgets`. With `stream=True` the body is generated as it
+        is sent rather than rendered up front.
+    """
     
     def __init__(self, path, *args, **kwargs):
         self.path = path
         self.args = args
         self.widgets = {}
-        if kwargs.get('widgets', False):
-            self.widgets.update(kwargs['widgets'])
-            del kwargs['widgets']
+        self.widgets.update(kwargs.pop('widgets', None) or {})
+        stream = kwargs.pop('stream', False)
         self.kwargs = kwargs
         self.template_kwargs = {}
         for name, value in self.kwargs.items():
@@ -35,28 +160,97 @@ class ResponseTemplate(Response):
                 del self.kwargs[name]
         
         self.template = env.get_template(path)
-        super(ResponseTemplate, self).__init__(
-            body=self.template.render(widgets=self.widgets, **self.template_kwargs), 
-            *self.args, 
-            **self.kwargs
-        )
+        if stream:
+            super(ResponseTemplate, self).__init__(
+                app_iter=self.generate(), 
+                *self.args, 
+                **self.kwargs
+            )
+        else:
+            super(ResponseTemplate, self).__init__(
+                body=self.template.render(widgets=self.widgets, **self.template_kwargs), 
+                *self.args, 
+                **self.kwargs
+            )
+    
+    def generate(self):
+        for chunk in self.template.generate(widgets=self.widgets, **self.template_kwargs):
+            yield chunk.encode(self.charset)
     
     def add_widgets(self, context, request, *widgets):
+        """ Renders `widgets` into an already rendered response, which means
+            rendering the template a second time. Views decorated with
+            `with_widgets` should return a TemplateSpec instead.
+        """
         render_widgets = {}
         for widget in widgets:
-            render_widgets[widget] = render_view(context,request,widget)
+            render_widgets[widget] = render_widget(context,request,widget)
         self.widgets.update(render_widgets)
         self.unicode_body = self.template.render(widgets=self.widgets, **self.template_kwargs)
     
 
-def with_widgets(*widgets):
+class TemplateSpec(object):
+    """ The template and arguments for a ResponseTemplate, left unrendered
+        so that `with_widgets` can render the page once its widgets are known
+    """
+    
+    def __init__(self, path, *args, **kwargs):
+        self.path = path
+        self.args = args
+        self.kwargs = kwargs
+    
+    def render(self, widgets=None, stream=False):
+        return ResponseTemplate(self.path, widgets=widgets, stream=stream, *self.args, **self.kwargs)
+    
+
+def render_widget(context, request, name):
+    """ Renders the widget view `name`, through the widget cache """
+    return widget_cache.render(context, request, name, render_view)
+
+def has_default_view(context, request, name, default):
+    """ Whether the view `name` found for `context` is the callable
+        `default`, rather than a view registered for its interfaces or class
+        (such as one for IVideo) which overrides it
+    """
+    adapters = getSiteManager().adapters
+    view = adapters.lookup((providedBy(context), providedBy(request)), IView, name=name)
+    return view is default
+
+def render_listing(items, request, name='video_listing_widget', default=None):
+    """ Renders the `name` widget for each video in `items` in a single pass
+        of `widgets/video_listings.html`, through the macro the widget's own
+        template uses. Videos whose `name` view is something other than
+        `default` (`video_listing_widget` unless given) are still rendered
+        through that view.
+    """
+    if default is None:
+        default = video_listing_widget
+    videos = []
+    for item in items:
+        if has_default_view(item, request, name, default):
+            videos.append(item)
+        else:
+            videos.append(render_widget(item, request, name))
+    return env.get_template('widgets/video_listings.html').render(videos=videos, request=request)
+
+def with_widgets(*widgets, **options):
+    """ Renders `widgets` for the decorated view. Views should return a
+        TemplateSpec, which is rendered in a single pass with the widgets
+        (streamed if the decorator is given `stream=True`).
+    """
+    stream = options.get('stream', False)
     def decorate(func):
         def wrapper(*args, **kwargs):
             response = func(*args, **kwargs)
-            if hasattr(response, 'add_widgets'):
+            if isinstance(response, TemplateSpec):
+                rendered = {}
+                for widget in widgets:
+                    rendered[widget] = render_widget(args[0], args[1], widget)
+                response = response.render(rendered, stream)
+            elif hasattr(response, 'add_widgets'):
                 response.add_widgets(args[0],args[1],*widgets)
             else:
-                log.warning('View function must return a ResponseTemplate object to support widgets')
+                log.warning('View function must return a TemplateSpec or ResponseTemplate object to support widgets')
             return response
         return wrapper
     return decorate
@@ -74,6 +268,9 @@ def logout(context, request):
 
 ## Widgets
 
+# seconds each main ad is shown for, which pages showing it are cached for too
+AD_ROTATION = 300
+
 @bfg_view(name='auth_widget')
 def auth_widget(context, request):
     return ResponseTemplate('widgets/auth.html', context=context, request=request)
@@ -99,18 +296,33 @@ def video_widget(context, request, default_video='intro'):
         video = videos.get(default_video)
     return ResponseTemplate('widgets/video.html', context=context, request=request, video=video)
 
+def vary_on_default_video(context, request):
+    video = utility_finder(context, 'videos').get(getattr(context, 'default_video', 'intro'))
+    video_serial = serial(video)
+    if video_serial is None:
+        return None
+    return (video.__name__, video_serial)
+
+widget_cache.register('auth_widget', vary_on_user)
+widget_cache.register('main_ad_widget', vary_on_slot(AD_ROTATION))
+widget_cache.register('tags_widget', vary_on_context)
+widget_cache.register('video_listing_widget', vary_on_context)
+widget_cache.register('video_widget', vary_on_default_video)
+
 
 ## Views
 
 @bfg_view(name='', for_=Root, permission='view')
+@cacheable_for_slot(AD_ROTATION)
 @with_widgets('auth_widget', 'main_ad_widget', 'video_widget')
 def index(context, request):
-    return ResponseTemplate('pages/index.html', context=context, request=request)
+    return TemplateSpec('pages/index.html', context=context, request=request)
 
 @bfg_view(name='index.html', for_=Root, permission='view')
+@cacheable_for_slot(AD_ROTATION)
 @with_widgets('auth_widget', 'main_ad_widget', 'video_widget')
 def index_page(context, request):
-    return ResponseTemplate('pages/index.html', context=context, request=request)
+    return TemplateSpec('pages/index.html', context=context, request=request)
 
 @bfg_view(name='set_default_video.html', for_=Root, request_type='GET', permission='edit')
 def set_default_video_form(context, request):
@@ -129,41 +341,111 @@ def set_default_video_action(context, request):
     return ResponseTemplate('pages/set_default_video.html', context=context, message='Default video set to %s' % video, videos=utility_finder(context, 'videos').values())
 
 
+@bfg_view(name='stats.json', for_=Root, permission='edit')
+def cache_stats(context, request):
+    data = {
+        'widgets': widget_cache.stats(),
+        'groups': groups_cache.stats(),
+        'credentials': credentials_cache.stats(),
+        'startup': startup_stats,
+    }
+    page_cache = request.environ.get('mint.page_cache')
+    if page_cache is not None:
+        data['pages'] = page_cache.stats()
+    connection = request.environ.get('mint.connection')
+    if connection is not None:
+        data['connections'] = connection.pool.stats()
+    return Response(json.dumps(data), content_type='application/json')
+
+@bfg_view(name='search.html', for_=Root, permission='view')
+@with_widgets('auth_widget')
+def search(context, request):
+    query = request.params.get('q', u'')
+    videos = utility_finder(context, 'videos')
+    page = videos.search(query, page_number(request), CONFIG['page_size'])
+    return TemplateSpec('pages/search.html', context=context, query=query, page=page)
+
+@bfg_view(name='search.json', for_=Root, permission='view')
+def search_json(context, request):
+    query = request.params.get('q', u'')
+    videos = utility_finder(context, 'videos')
+    page = videos.search(query, page_number(request), CONFIG['page_size'])
+    results = []
+    for (uid, score), video in zip(page.items.keys, page.items):
+        results.append({
+            'id': uid,
+            'name': video.name,
+            'description': video.description,
+            'tags': list(video.tags),
+            'url': '/videos/%s' % uid,
+            'score': score,
+        })
+    data = {
+        'query': query,
+        'page': page.number,
+        'pages': page.pages,
+        'total': page.total,
+        'results': results,
+    }
+    return Response(json.dumps(data), content_type='application/json')
+
 @bfg_view(name='video_redirect')
 def video_redirect(context, request):
     return redirect(location = '/videos/' + context.video_name)
 
 @bfg_view(for_=IVideo, permission='view')
+@cacheable
 @with_widgets('auth_widget', 'tags_widget')
 def video(context, request):
-    channels = utility_finder(context, 'channels')
-    pre = []
-    post = []
-    for tag in context.tags:
-        channel = channels[tag]
-        if channel.pre_roll:
-            pre.append(channel.pre_roll)
-        if channel.end_roll:
-            post.append(channel.end_roll)
+    pre, post = utility_finder(context, 'channels').get_stings(context.tags)
     playlist = context.get_playlist(pre, post)
-    return ResponseTemplate('pages/video.html', context=context, playlist=playlist)
+    return TemplateSpec('pages/video.html', context=context, playlist=playlist)
 
 @bfg_view(for_=IChannel, permission='view')
+@cacheable
 @with_widgets('auth_widget')
 def channel(context, request):
-    videos = [render_view(video,request,'video_listing_widget') for video in context.get_listings()]
+    page = context.get_page(page_number(request), CONFIG['page_size'])
+    listing = render_listing(page.items, request)
     title = context.title or context.__name__.title()
-    return ResponseTemplate('pages/channel.html', context=context, videos=videos, title=title)
+    return TemplateSpec('pages/channel.html', context=context, listing=listing, title=title, page=page)
 
 @bfg_view(name='profile.html', for_=IUser)
 def user_profile(context, request):
     return ResponseTemplate('pages/user/profile.html', context=context)
 
+def feed_validators(version, page):
+    """ Returns the ETag and Last-Modified time (or None) for `page` of a
+        feed at `version` (see ISyndication.get_feed_version)
+        
+        >>> from persistent.TimeStamp import TimeStamp
+        >>> serial = repr(TimeStamp(2009, 6, 1, 12, 0, 0))
+        >>> etag, modified = feed_validators(((-1.0, u'intro'), (serial, '\\x00' * 8)), 1)
+        >>> etag == feed_validators(((-1.0, u'intro'), (serial, '\\x00' * 8)), 2)[0], modified
+        (False, 1243857600)
+    """
+    newest, serials = version
+    etag = '"%s"' % md5(repr((newest, serials, page))).hexdigest()
+    modified = [TimeStamp(serial).timeTime() for serial in serials if serial and serial != z64]
+    if not modified:
+        return etag, None
+    return etag, int(max(modified))
+
 @bfg_view(name='podcast.xml', for_=ISyndication)
+@cacheable
 def rss_feed(context, request):
+    page = page_number(request)
+    etag, last_modified = feed_validators(context.get_feed_version(), page)
+    headers = [('ETag', etag)]
+    if last_modified is not None:
+        headers.append(('Last-Modified', formatdate(last_modified, usegmt=True)))
+    if not_modified(request.environ, etag, last_modified):
+        return Response(status=304, headerlist=headers)
     metadata = context.metadata
-    items = context.get_listings()
-    return ResponseTemplate('pages/podcast.xml', metadata=metadata, items=items)
+    items = context.get_page(page, CONFIG['feed_size']).items
+    response = ResponseTemplate('pages/podcast.xml', metadata=metadata, items=items, stream=True)
+    response.headers.update(dict(headers))
+    return response
 
 
 ## Admin Views
@@ -220,6 +502,8 @@ def edit_channel_action(context, request):
     
     context.pre_roll = form.get('sting.pre_roll', '')
     context.end_roll = form.get('sting.end_roll', '')
+    channels.update_stings(context)
+    feed_publisher.queue(find_root(context), ('channels', name))
     transaction.commit()
     sting_videos = [('', 'No Video')]
     sting_videos.extend([(video.__name__, video.name) for video in videos.values()])
@@ -233,7 +517,8 @@ def add_video_form(context, request):
 
 @bfg_view(name='add_video.html', for_=IVideoContainer, request_type='POST', permission='edit')
 def add_video_action(context, request):
-    form = request.POST
+    # the spooled uploads must be on the same filesystem as the encodes
+    form = spooled_post(request, join(CONFIG.get('video_dir', context.encode_dir), '.uploads'))
     name = form.get('video.name')
     description = form.get('video.description')
     tags = form.get('video.tags')
@@ -269,6 +554,7 @@ def edit_video_action(context, request):
     context.name = name
     context.description = description
     context.tags = tags.replace(' ','').split(',')
+    context.__parent__.index_video(context)
     context.pre_roll = form.get('sting.pre_roll', '')
     context.end_roll = form.get('sting.end_roll', '')
     transaction.commit()
@@ -50,6 +50,10 @@ setup(name='mint.repoze',
       entry_points = """\
       [paste.app_factory]
       app = mint.repoze.run:makeapp
+      encodes = mint.repoze.fileserver:make_encodes_app
+      static = mint.repoze.assets:make_static_app
+      [console_scripts]
+      mint-import = mint.repoze.importer:main
       """
       )
 